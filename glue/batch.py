@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from StringIO import StringIO
+
+from glue.bin import main
+from glue.cache import ImageCache
+from glue.helpers import parse_size
+
+
+def run_job(args, cache=None):
+    """Run ``glue`` using the arguments ``args`` sharing ``cache`` with other
+    builds. Return a dictionary with the status, exit code, elapsed time,
+    output and written files of the build."""
+    output, errors, written = StringIO(), StringIO(), []
+    start = time.time()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = output, errors
+    try:
+        code = main(['glue'] + list(args), cache=cache, written=written)
+    except SystemExit, e:
+        # argparse exits if the arguments are invalid
+        code = e.code
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    return {'status': 'ok' if code == 0 else 'error',
+            'code': code,
+            'time': round(time.time() - start, 3),
+            'output': output.getvalue(),
+            'errors': errors.getvalue(),
+            'outputs': written}
+
+
+# ImageCache of every process of the pool used by run_parallel
+_cache = None
+
+
+def _init_worker(cache_size):
+    global _cache
+    _cache = ImageCache(cache_size)
+    # Pool processes are daemonic, which wouldn't let jobs using --jobs
+    # start their own processes.
+    multiprocessing.current_process().daemon = False
+
+
+def _run_job(args):
+    return run_job(args, _cache)
+
+
+def load_jobs(path):
+    """Return the list of ``(name, args)`` of the jobs file at ``path``.
+    Every job is either a list of arguments or an object with ``args`` and
+    optionally ``name``."""
+    with open(path) as f:
+        jobs = json.load(f)
+    if not isinstance(jobs, list):
+        raise ValueError('The jobs file must contain a list of jobs')
+
+    result = []
+    for job in jobs:
+        if isinstance(job, dict):
+            name, args = job.get('name'), job.get('args')
+        else:
+            name, args = None, job
+        if not isinstance(args, list) or not all(isinstance(a, basestring) for a in args):
+            raise ValueError('Invalid job: {0}'.format(json.dumps(job)))
+        result.append((name or ' '.join(args), args))
+    return result
+
+
+def run_batch(jobs, processes=1, cache_size='256M'):
+    """Yield the result of every job in ``jobs`` (a list of arguments), in
+    order. Jobs share the decoded images of a :class:`~ImageCache`, one for
+    every one of the ``processes`` processes used."""
+    cache_size = parse_size(cache_size)
+    if processes == 1 or len(jobs) == 1:
+        cache = ImageCache(cache_size)
+        for args in jobs:
+            yield run_job(args, cache)
+        return
+
+    pool = multiprocessing.Pool(min(processes, len(jobs)), _init_worker, (cache_size,))
+    try:
+        for result in pool.imap(_run_job, jobs):
+            yield result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def batch(argv):
+    """Entry point of ``glue batch``."""
+    parser = argparse.ArgumentParser(prog='glue batch',
+                                     description="Run every glue job of a jobs file in one process.")
+
+    parser.add_argument("jobs_file",
+                        metavar='FILE',
+                        help="JSON file containing a list of jobs")
+
+    parser.add_argument("-j", "--jobs",
+                        dest="jobs",
+                        type=int,
+                        metavar='N',
+                        default=int(os.environ.get('GLUE_BATCH_JOBS', 1)),
+                        help=("Run up to N jobs at the same time. Use 0 to "
+                              "use one process per CPU (default: 1)"))
+
+    parser.add_argument("--cache-size",
+                        dest="cache_size",
+                        metavar='SIZE',
+                        default=os.environ.get('GLUE_BATCH_CACHE_SIZE', '256M'),
+                        help=("Memory used to keep decoded images between "
+                              "jobs (default: 256M)"))
+
+    parser.add_argument("--report",
+                        dest="report",
+                        metavar='FILE',
+                        default=os.environ.get('GLUE_BATCH_REPORT', None),
+                        help="Write the result of every job into this JSON file")
+
+    parser.add_argument("-q", "--quiet",
+                        dest="quiet",
+                        action='store_true',
+                        default=os.environ.get('GLUE_BATCH_QUIET', False),
+                        help="Only print the status of every job")
+
+    options = parser.parse_args(argv)
+
+    try:
+        parse_size(options.cache_size)
+    except ValueError:
+        parser.error("Invalid --cache-size '{0}'.".format(options.cache_size))
+
+    if options.jobs < 0:
+        parser.error("--jobs must be 0 or a positive number.")
+
+    try:
+        jobs = load_jobs(options.jobs_file)
+    except (IOError, ValueError), e:
+        parser.error("Unable to read the jobs file: {0}".format(e))
+
+    report = []
+    processes = options.jobs or multiprocessing.cpu_count()
+    results = run_batch([args for name, args in jobs], processes, options.cache_size)
+    for number, ((name, args), result) in enumerate(zip(jobs, results), 1):
+        print "Job {0}/{1} '{2}': {3} (code {4}) in {5:.3f}s".format(
+            number, len(jobs), name, result['status'], result['code'], result['time'])
+        if not options.quiet:
+            sys.stdout.write(result['output'])
+        sys.stderr.write(result['errors'])
+        report.append(dict(result, name=name, args=args))
+
+    failed = [r for r in report if r['code'] != 0]
+    print "{0} jobs finished, {1} failed".format(len(report), len(failed))
+
+    if options.report:
+        with open(options.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return failed[0]['code'] if failed else 0
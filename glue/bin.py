@@ -5,17 +5,33 @@ import argparse
 
 from PIL import Image as PImage
 
-from glue.formats import formats
-from glue.helpers import redirect_stdout
+from glue.formats import formats, ImageFormat
+from glue.helpers import redirect_stdout, parse_size, parse_shard
 from glue import exceptions
 from glue import managers
 from glue import __version__
 
 
-def main(argv=None):
+def main(argv=None, cache=None, written=None):
+    """Run glue using the command line arguments ``argv`` and return the
+    exit code.
+
+    ``glue serve`` and ``glue batch`` build sprites using this function too:
+    ``cache`` is the :class:`~ImageCache` shared between builds and the path
+    of every file written is appended to ``written``.
+    """
 
     argv = (argv or sys.argv)[1:]
 
+    # Subcommands, unless there is a source folder using the same name
+    if argv[:1] == ['serve'] and not os.path.isdir('serve'):
+        from glue.server import serve
+        return serve(argv[1:])
+
+    if argv[:1] == ['batch'] and not os.path.isdir('batch'):
+        from glue.batch import batch
+        return batch(argv[1:])
+
     parser = argparse.ArgumentParser(usage=("usage: %(prog)s [source | --source | -s] [output | --output | -o]"))
 
     parser.add_argument("--source", "-s",
@@ -49,6 +65,22 @@ def main(argv=None):
                         default=os.environ.get('GLUE_FOLLOW_LINKS', False),
                         help="Follow symbolic links.")
 
+    parser.add_argument("--include",
+                        dest="include",
+                        type=unicode,
+                        metavar='PATTERNS',
+                        default=os.environ.get('GLUE_INCLUDE', None),
+                        help=("Only add images matching any of these comma "
+                              "separated glob patterns"))
+
+    parser.add_argument("--exclude",
+                        dest="exclude",
+                        type=unicode,
+                        metavar='PATTERNS',
+                        default=os.environ.get('GLUE_EXCLUDE', None),
+                        help=("Ignore files and folders matching any of these "
+                              "comma separated glob patterns"))
+
     parser.add_argument("-f", "--force",
                         dest="force",
                         action='store_true',
@@ -64,12 +96,97 @@ def main(argv=None):
                         help=("Watch the source folder for changes and rebuild "
                               "when new files appear, disappear or change."))
 
+    parser.add_argument("--watch-cache-size",
+                        dest="watch_cache_size",
+                        type=unicode,
+                        metavar='SIZE',
+                        default=os.environ.get('GLUE_WATCH_CACHE_SIZE', '256M'),
+                        help=("Memory used by --watch to keep decoded images "
+                              "between rebuilds (default: 256M)"))
+
+    parser.add_argument("--artifact-cache",
+                        dest="artifact_cache",
+                        type=unicode,
+                        metavar='DIR',
+                        default=os.environ.get('GLUE_ARTIFACT_CACHE', None),
+                        help=("Store the outputs of every sprite in DIR and "
+                              "reuse them instead of building sprites again"))
+
+    parser.add_argument("--artifact-cache-size",
+                        dest="artifact_cache_size",
+                        type=unicode,
+                        metavar='SIZE',
+                        default=os.environ.get('GLUE_ARTIFACT_CACHE_SIZE', '1G'),
+                        help=("Maximum size of the --artifact-cache folder "
+                              "(default: 1G)"))
+
+    parser.add_argument("--plan",
+                        dest="plan",
+                        action='store_true',
+                        default=os.environ.get('GLUE_PLAN', False),
+                        help=("Report which sprites and files would be rebuilt "
+                              "and why, without building anything."))
+
+    parser.add_argument("--check",
+                        dest="check",
+                        action='store_true',
+                        default=os.environ.get('GLUE_CHECK', False),
+                        help=("Check that every output file is up to date "
+                              "without building anything. Useful for CI."))
+
     parser.add_argument("--project",
                         dest="project",
                         action="store_true",
                         default=os.environ.get('GLUE_PROJECT', False),
                         help="Generate sprites for multiple folders")
 
+    parser.add_argument("--shard",
+                        dest="shard",
+                        metavar='I/N',
+                        default=os.environ.get('GLUE_SHARD', None),
+                        help=("Split the sprites of the project in N shards "
+                              "and only build the shard I"))
+
+    parser.add_argument("--shard-merge",
+                        dest="shard_merge",
+                        type=int,
+                        metavar='N',
+                        default=int(os.environ.get('GLUE_SHARD_MERGE', 0)),
+                        help=("Make sure the N shards of the project have "
+                              "been built without writing anything"))
+
+    parser.add_argument("-j", "--jobs",
+                        dest="jobs",
+                        type=int,
+                        metavar='N',
+                        default=int(os.environ.get('GLUE_JOBS', 1)),
+                        help=("Build up to N sprites at the same time. Use 0 "
+                              "to use one process per CPU (default: 1)"))
+
+    parser.add_argument("--build-threads",
+                        dest="build_threads",
+                        type=int,
+                        metavar='N',
+                        default=int(os.environ.get('GLUE_BUILD_THREADS', 1)),
+                        help=("Build the formats of every sprite using N "
+                              "threads. Use 0 to use one thread per CPU "
+                              "(default: 1)"))
+
+    parser.add_argument("--io-threads",
+                        dest="io_threads",
+                        type=int,
+                        metavar='N',
+                        default=int(os.environ.get('GLUE_IO_THREADS', 1)),
+                        help=("Read up to N source images at the same time. "
+                              "Useful on network filesystems (default: 1)"))
+
+    parser.add_argument("--stream-sprites",
+                        dest="stream_sprites",
+                        action="store_true",
+                        default=os.environ.get('GLUE_STREAM_SPRITES', False),
+                        help=("Build, save and release one sprite at a time "
+                              "instead of loading every sprite first"))
+
     parser.add_argument("-v", "--version",
                         action="version",
                         version='%(prog)s ' + __version__,
@@ -133,12 +250,14 @@ def main(argv=None):
     # Get the list of enabled formats
     options.enabled_formats = [f for f in formats if getattr(options, '{0}_dir'.format(f), False)]
 
-    # If there is only one enabled format (img) or if there are two (img, html)
-    # this means glue is been executed without any specific main format.
-    # In order to keep the legacy API we need to enable css.
+    # If the only enabled formats are image formats (img, webp...) and
+    # optionally html this means glue is been executed without any specific
+    # main format. In order to keep the legacy API we need to enable css.
     # As consequence there is no way to make glue only generate the sprite
     # image and the html file without generating the css file too.
-    if set(options.enabled_formats) in (set(['img']), set(['img', 'html'])) and options.generate_css:
+    main_formats = [f for f in options.enabled_formats
+                    if f != 'html' and not issubclass(formats[f], ImageFormat)]
+    if not main_formats and options.generate_css:
         options.enabled_formats.append('css')
         setattr(options, "css_dir", True)
 
@@ -212,27 +331,76 @@ def main(argv=None):
     if not options.generate_image and isinstance(options.img_dir, bool):
         options.img_dir = options.output
 
+    for option in ('watch_cache_size', 'artifact_cache_size'):
+        try:
+            parse_size(getattr(options, option))
+        except ValueError:
+            parser.error("Invalid --{0} '{1}'.".format(option.replace('_', '-'), getattr(options, option)))
+
+    if options.artifact_cache:
+        options.artifact_cache = os.path.abspath(options.artifact_cache)
+
+    if options.shard:
+        try:
+            parse_shard(options.shard)
+        except ValueError:
+            parser.error("Invalid --shard '{0}'. Use I/N, for example 1/4.".format(options.shard))
+
+    if (options.shard or options.shard_merge) and not options.project:
+        parser.error("--shard and --shard-merge can only be used with --project.")
+
+    if options.shard and options.shard_merge:
+        parser.error("--shard can't be used with --shard-merge.")
+
+    if options.shard_merge < 0:
+        parser.error("--shard-merge must be a positive number.")
+
+    if options.jobs < 0:
+        parser.error("--jobs must be 0 or a positive number.")
+
+    if options.io_threads < 1:
+        parser.error("--io-threads must be a positive number.")
+
+    if options.build_threads < 0:
+        parser.error("--build-threads must be 0 or a positive number.")
+
     # Apply formats constraints
     for format in options.enabled_formats:
         formats[format].apply_parser_contraints(parser, options)
 
+    if cache is not None and options.watch:
+        parser.error("--watch can't be used while building through glue serve or glue batch.")
+
     if options.project:
         manager_cls = managers.ProjectManager
     else:
         manager_cls = managers.SimpleManager
 
     # Generate manager or defer the creation to a WatchManager
-    if options.watch:
+    if options.watch and not (options.plan or options.check or options.shard_merge):
         manager = managers.WatchManager(manager_cls, vars(options))
     else:
         manager = manager_cls(**vars(options))
+        manager.cache = cache
+
+    # Only report what would be done if --plan or --check are used
+    if options.shard_merge:
+        action = manager.merge_shards
+    elif options.plan:
+        action = manager.plan
+    elif options.check:
+        action = manager.check
+    else:
+        action = manager.process
 
     try:
         if options.quiet:
             with redirect_stdout():
-                manager.process()
+                action()
         else:
-            manager.process()
+            action()
+        if written is not None:
+            written.extend(manager.written)
     except exceptions.ValidationError, e:
         sys.stderr.write(e.args[0])
         return e.error_code
@@ -242,6 +410,14 @@ def main(argv=None):
     except exceptions.NoSpritesFoldersFoundError, e:
         sys.stderr.write("Error: No sprites folders found in %s.\n" % e.args[0])
         return e.error_code
+    except exceptions.StaleOutputsError, e:
+        sys.stderr.write("Error: {0} output files are not up to date.\n".format(len(e.args[0])))
+        return e.error_code
+    except exceptions.MemoryLimitExceededError, e:
+        sys.stderr.write(("Error: Sprite '{0}' needs about {1} MB of memory "
+                          "but --max-memory only allows {2} MB.\n").format(
+                          e.args[0], e.args[1] // 1024 ** 2, e.args[2] // 1024 ** 2))
+        return e.error_code
     except exceptions.PILUnavailableError, e:
         sys.stderr.write(("Error: PIL {0} decoder is unavailable"
                           "Please read the documentation and "
@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+import threading
+import collections
+
+from glue.helpers import makedirs, atomic_write
+
+
+class ImageCache(object):
+    """State kept between builds by long running processes like ``--watch``.
+
+    * ``records`` stores everything glue knows about an image file (digest,
+      size, crop box) or a sprite (layout) which is cheap to keep.
+    * Decoded images and canvases are kept in a LRU bounded to ``max_bytes``.
+
+    Image keys include the size and modification time of the file, so a
+    changed file never reuses stale data.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.records = {}
+        self.size = 0
+        self._pixels = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, key):
+        """Return the (mutable) record stored for ``key``."""
+        with self._lock:
+            return self.records.setdefault(key, {})
+
+    def get(self, key):
+        """Return the value stored for ``key`` using :meth:`put`, or
+        ``None``."""
+        with self._lock:
+            entry = self._pixels.pop(key, None)
+            if entry is None:
+                return None
+            # Mark it as the most recently used entry
+            self._pixels[key] = entry
+            return entry[0]
+
+    def put(self, key, value, image):
+        """Store ``value`` for ``key``. The size of the PIL ``image`` is used
+        to keep the cache under ``max_bytes``, evicting the least recently
+        used entries."""
+        nbytes = image.size[0] * image.size[1] * len(image.getbands())
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._pixels.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self._pixels[key] = (value, nbytes)
+            self.size += nbytes
+
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._pixels.popitem(last=False)
+                self.size -= evicted
+
+
+class ArtifactCache(object):
+    """Folder (which can be shared by several machines) where the outputs
+    of every sprite are stored under its hash.
+
+    Every entry is a folder named after the hash of the sprite containing
+    one folder for every format. Entries are written into a temporary
+    folder and renamed, so other processes never see half-written entries.
+    Once the folder grows over ``max_bytes`` the least recently used entries
+    are removed.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def restore(self, key, outputs):
+        """Copy the stored ``outputs`` (a list of ``(format_name, path)``) of
+        the entry ``key``. Return ``False`` if any of them is missing."""
+        entry = self.entry_path(key)
+        sources = [(os.path.join(entry, format_name, os.path.basename(path)), path)
+                   for format_name, path in outputs]
+        if not all(os.path.isfile(source) for source, _ in sources):
+            return False
+
+        try:
+            for source, path in sources:
+                makedirs(os.path.dirname(path))
+                with open(source, 'rb') as src, atomic_write(path) as dst:
+                    shutil.copyfileobj(src, dst)
+        except (IOError, OSError):
+            # The entry was evicted by other process meanwhile
+            return False
+
+        # Mark the entry as recently used
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return True
+
+    def store(self, key, outputs):
+        """Store ``outputs`` (a list of ``(format_name, path)``) as the entry
+        ``key`` unless it already exists."""
+        entry = self.entry_path(key)
+        if os.path.isdir(entry):
+            return
+
+        makedirs(self.path)
+        tmp = tempfile.mkdtemp(prefix='.tmp-{0}-'.format(key), dir=self.path)
+        try:
+            for format_name, path in outputs:
+                makedirs(os.path.join(tmp, format_name))
+                shutil.copyfile(path, os.path.join(tmp, format_name, os.path.basename(path)))
+            os.rename(tmp, entry)
+        except OSError:
+            # Other process stored the same entry first
+            if not os.path.isdir(entry):
+                raise
+        finally:
+            shutil.rmtree(tmp, True)
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the size of the cache
+        is under ``max_bytes``."""
+        entries = []
+        for name in os.listdir(self.path):
+            path = self.entry_path(name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            # Other processes may be removing or storing this entry
+            try:
+                size = 0
+                for root, dirs, files in os.walk(path, onerror=self._raise):
+                    size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                shutil.rmtree(path)
+            except OSError:
+                # Unless other process removed it first
+                if os.path.isdir(path):
+                    continue
+            total -= size
+
+    @staticmethod
+    def _raise(error):
+        raise error
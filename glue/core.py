@@ -2,16 +2,22 @@ import re
 import os
 import sys
 import copy
+import json
 import hashlib
 import StringIO
 import ConfigParser
 
+from multiprocessing.pool import ThreadPool
+
 from PIL import Image as PILImage
 
+from glue import __version__
+from glue import discovery
 from glue.algorithms import algorithms
-from glue.helpers import cached_property, round_up
-from glue.formats import ImageFormat
-from glue.exceptions import SourceImagesNotFoundError, PILUnavailableError
+from glue.helpers import cached_property, round_up, parse_size
+from glue.formats import formats, ImageFormat
+from glue.exceptions import (SourceImagesNotFoundError, PILUnavailableError,
+                             MemoryLimitExceededError)
 
 
 class ConfigurableFromFile(object):
@@ -35,8 +41,12 @@ class ConfigurableFromFile(object):
 
 class Image(ConfigurableFromFile):
 
-    def __init__(self, path, config):
+    def __init__(self, path, config, cache=None, stat=None):
         self.path = path
+        self.cache = cache
+        if stat is not None:
+            # Reuse the stat done while discovering this image
+            self.stat = [stat.st_size, stat.st_mtime]
         self.filename = os.path.basename(path)
         self.dirname = self.config_path = os.path.dirname(path)
 
@@ -46,15 +56,65 @@ class Image(ConfigurableFromFile):
         self.x = self.y = None
         self.original_width = self.original_height = 0
 
-        with open(self.path, "rb") as img:
-            self._image_data = img.read()
+        # Result of reading this file in the background, see Sprite.prefetch
+        self.prefetched = None
 
         print "\t{0} added to sprite".format(self.filename)
 
     @cached_property
-    def image(self):
-        """Return a Pil representation of this image """
-        io = StringIO.StringIO(self._image_data)
+    def digest(self):
+        """Return the sha1 digest of the data of this image."""
+        return self._store_digest(self.data)
+
+    def _store_digest(self, data):
+        record = self._record()
+        if 'digest' not in record:
+            record['digest'] = hashlib.sha1(data).hexdigest()
+        self.digest = record['digest']
+        return self.digest
+
+    @property
+    def data(self):
+        """Return the content of this image file. Only files read in the
+        background (see :meth:`Sprite.prefetch`) are kept until the image is
+        released, otherwise the file is read every time."""
+        if self.prefetched is not None:
+            return self.prefetched.get()
+        return self.read()
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    @cached_property
+    def stat(self):
+        """Return the size and modification time of this image file."""
+        stat = os.stat(self.path)
+        return [stat.st_size, stat.st_mtime]
+
+    @cached_property
+    def cache_key(self):
+        """Return the key of this image inside the :class:`~ImageCache`."""
+        return (self.path,) + tuple(self.stat) + (bool(self.config['crop']),)
+
+    def _record(self):
+        """Return the cache record of this image, or an empty dictionary if
+        there is no cache."""
+        return self.cache.record(self.cache_key) if self.cache else {}
+
+    def reuse_digest(self, entry):
+        """Reuse the digest of a previous build manifest ``entry`` if this
+        image file has the same size and modification time."""
+        if entry and list(entry[:2]) == self.stat:
+            self.digest = entry[2]
+
+    def _decode(self):
+        """Return a RGBA PIL image containing the whole source image."""
+        data = self.data
+        if 'digest' not in self.__dict__:
+            # Don't read the file again only to hash it
+            self._store_digest(data)
+        io = StringIO.StringIO(data)
         try:
             source_image = PILImage.open(io)
             img = PILImage.new('RGBA', source_image.size, (0, 0, 0, 0))
@@ -72,23 +132,67 @@ class Image(ConfigurableFromFile):
             io.close()
 
         self.original_width, self.original_height = img.size
+        return img
 
-        # Crop the image searching for the smallest possible bounding box
-        # without losing any non-transparent pixel.
-        # This crop is only used if the crop flag is set in the config.
+    @cached_property
+    def bbox(self):
+        """Return the area of the source image used by this sprite."""
+        record = self._record()
+        if 'bbox' not in record:
+            record['bbox'] = self._find_bbox()
+            record['original_size'] = (self.original_width, self.original_height)
+        self.original_width, self.original_height = record['original_size']
+        return record['bbox']
+
+    def _find_bbox(self):
+        """If the crop flag is set in the config, return the smallest
+        possible bounding box without losing any non-transparent pixel. If
+        not, only the image header needs to be read."""
         if self.config['crop']:
-            img = img.crop(img.split()[-1].getbbox())
+            img = self._decode()
+            return img.split()[-1].getbbox() or (0, 0) + img.size
+
+        # Only read the header unless the file is being read anyway
+        if self.prefetched is not None:
+            source = StringIO.StringIO(self.data)
+        else:
+            source = self.path
+        try:
+            self.original_width, self.original_height = PILImage.open(source).size
+        except IOError, e:
+            raise PILUnavailableError(e.args[0].split()[1])
+        return (0, 0, self.original_width, self.original_height)
+
+    @cached_property
+    def image(self):
+        """Return a Pil representation of this image """
+        img = self.cache.get(self.cache_key) if self.cache else None
+        if img is None:
+            img = self._decode()
+            if self.config['crop']:
+                img = img.crop(self.bbox)
+            if self.cache:
+                self.cache.put(self.cache_key, img, img)
         return img
 
+    def release(self):
+        """Free the data and decoded pixels of this image. They will be read
+        and decoded again if they are needed."""
+        if self.prefetched is not None:
+            # The digest is always needed, don't read the file again for it
+            self.digest
+        self.__dict__.pop('image', None)
+        self.prefetched = None
+
     @property
     def width(self):
         """Return Image width"""
-        return self.image.size[0]
+        return self.bbox[2] - self.bbox[0]
 
     @property
     def height(self):
         """Return Image height"""
-        return self.image.size[1]
+        return self.bbox[3] - self.bbox[1]
 
     @property
     def padding(self):
@@ -166,8 +270,18 @@ class Sprite(ConfigurableFromFile):
     config_section = 'sprite'
     valid_extensions = ['png', 'jpg', 'jpeg', 'gif']
 
-    def __init__(self, path, config, name=None):
+    # Config keys changing the pixels or the layout of the canvas. Together
+    # with the source images they are the hash of the sprite. Options only
+    # used by some formats are part of the hash of those formats instead.
+    image_config = ('algorithm', 'algorithm_ordering', 'ratios', 'crop',
+                    'padding', 'margin', 'png8', 'png8_alpha')
+
+    # Config keys every image can override using sprite.conf
+    image_overrides = ('algorithm_ordering', 'crop', 'padding', 'margin')
+
+    def __init__(self, path, config, name=None, layout=True, cache=None):
         self.path = self.config_path = path
+        self.cache = cache
         self.config = copy.deepcopy(config)
         self.config.update(self._get_config_from_file('sprite.conf', 'sprite'))
         self.name = name or self.config.get('name', os.path.basename(path))
@@ -187,42 +301,186 @@ class Sprite(ConfigurableFromFile):
         # Discover images inside this sprite
         self.images = self._locate_images()
 
+        # Reuse the digest of every image which didn't change since the
+        # previous build.
+        if self.previous_manifest:
+            for image in self.images:
+                image.reuse_digest(self.previous_manifest['files'].get(self.image_key(image)))
+
         img_format = ImageFormat(sprite=self)
         for ratio in ratios:
             ratio_output_key = 'ratio_{0}_output'.format(ratio)
             if ratio_output_key not in self.config:
                 self.config[ratio_output_key] = img_format.output_path(ratio)
 
-        print "Processing '{0}':".format(self.name)
+        self.laid_out = layout
+        if layout:
+            print "Processing '{0}':".format(self.name)
 
-        # Generate sprite map
-        self.process()
+            # Generate sprite map
+            self.process()
+
+    def prefetch(self, images):
+        """Read the data of ``images`` using a pool of ``io_threads`` threads,
+        in order. On network filesystems the
+        latency of every read is much bigger than the time needed to
+        transfer small files, so several reads are done at the same time."""
+        threads = int(self.config.get('io_threads') or 1)
+        if threads < 2 or len(images) < 2:
+            return
+
+        pool = ThreadPool(min(threads, len(images)))
+        for image in images:
+            image.prefetched = pool.apply_async(image.read)
+        # Workers exit once every file has been read
+        pool.close()
 
     def process(self):
+        # Reuse the previous layout if nothing affecting it changed
+        record = signature = None
+        if self.cache:
+            record = self.cache.record(('layout', self.path))
+            signature = (self.config['algorithm'], self.max_ratio,
+                         [(i.cache_key, i.absolute_width, i.absolute_height) for i in self.images])
+            if record.get('signature') == signature:
+                for image, (x, y) in zip(self.images, record['positions']):
+                    image.x, image.y = x, y
+                return
+
         algorithm_cls = algorithms[self.config['algorithm']]
         algorithm = algorithm_cls()
         algorithm.process(self)
 
+        if record is not None:
+            record.update(signature=signature, positions=[(i.x, i.y) for i in self.images])
+
     def validate(self):
-        pass
+        """Make sure the images of this sprite can be built using the memory
+        allowed by ``max_memory``. If they can't, but they could while
+        streaming them, ``streaming`` is enabled."""
+        if not self.config.get('max_memory'):
+            return
+
+        image_formats = [formats[f] for f in self.config['enabled_formats']
+                         if issubclass(formats[f], ImageFormat)]
+        if not image_formats:
+            return
+
+        budget = parse_size(self.config['max_memory'])
+        img_format = ImageFormat(sprite=self)
+        usage = img_format.memory_usage(streaming=self.config['streaming'])
+        if usage <= budget:
+            return
+
+        if not self.config['streaming'] and img_format.can_stream(image_formats):
+            usage = img_format.memory_usage(streaming=True)
+            if usage <= budget:
+                print "\tUsing --streaming to build '{0}' within --max-memory".format(self.name)
+                self.config['streaming'] = True
+                return
+
+        raise MemoryLimitExceededError(self.name, usage, budget)
 
     @cached_property
     def hash(self):
-        """ Return a hash of this sprite. In order to detect any change on
-        the source images  it use the data, order and path of each image.
-        In the same way it use this sprite settings as part of the hash.
+        """ Return a hash of the canvas of this sprite. In order to detect any
+        change on the source images it use the data, order and path of each
+        image, plus the settings in ``image_config``.
         """
-        hash_list = []
+        values = []
         for image in self.images:
-            hash_list.append(os.path.relpath(image.path))
-            hash_list.append(image._image_data)
-
-        for key, value in self.config.iteritems():
+            values.append(self.image_key(image))
+            values.append(image.digest)
+            values.extend(image.config.get(key) for key in self.image_overrides)
+        return self.config_hash(self.image_config, *values)
+
+    def config_hash(self, keys, *values):
+        """Return a hash of the config ``keys`` of this sprite followed by
+        ``values``. Paths are relative to the source, so the hash doesn't
+        depend on where the project is."""
+        source = self.config.get('source') or self.path
+        hash_list = []
+        for key in keys:
+            value = self.config.get(key)
+            if isinstance(value, basestring) and os.path.isabs(value):
+                value = os.path.relpath(value, source)
             hash_list.append(key)
             hash_list.append(value)
-
+        hash_list.extend(values)
         return hashlib.sha1(''.join(map(str, hash_list))).hexdigest()[:10]
 
+    def image_key(self, image):
+        """Return the path of ``image`` relative to this sprite."""
+        return os.path.relpath(image.path, self.path)
+
+    @property
+    def manifest(self):
+        """Return a description of every input of this sprite. It is stored
+        next to the sprite images in order to explain future rebuilds and to
+        avoid reading images which didn't change."""
+        config = dict((k, self.config.get(k))
+                      for k in self.image_config + ImageFormat.hash_config)
+        files = dict((self.image_key(i), i.stat + [i.digest]) for i in self.images)
+        manifest = {'version': __version__, 'hash': self.hash,
+                    'image_hash': ImageFormat(sprite=self).hash,
+                    'config': config, 'files': files}
+
+        # Where every image was pasted, so following builds can repaint
+        # only the images which changed.
+        if self.laid_out:
+            manifest['layout'] = {
+                'canvas': list(self.canvas_size),
+                'images': dict((self.image_key(i), list(self.paste_position(i)) + [i.width, i.height])
+                               for i in self.images)}
+        return manifest
+
+    @cached_property
+    def previous_manifest(self):
+        """Return the manifest stored by the previous build of this sprite,
+        or ``None`` if it isn't available."""
+        if self.config['css_cachebuster_filename'] or self.config['css_cachebuster_only_sprites']:
+            # The path of the image depends on the hash
+            return None
+        try:
+            img_format = ImageFormat(sprite=self)
+            with open(img_format.manifest_path()) as f:
+                manifest = json.load(f)
+            # Ignore the manifest if the image was replaced since then
+            path = img_format.output_path(self.max_ratio)
+            if img_format.read_metadata(path)['Comment'] != manifest['image_hash']:
+                return None
+            return manifest
+        except Exception:
+            return None
+
+    def changes(self):
+        """Return a list describing what changed since the previous build of
+        this sprite according to its manifest."""
+        previous = self.previous_manifest
+        if previous is None:
+            return ['no previous build manifest']
+
+        current = json.loads(json.dumps(self.manifest))
+        changes = []
+        if previous['version'] != current['version']:
+            changes.append('glue version changed ({0} -> {1})'.format(previous['version'], current['version']))
+
+        old, new = previous['files'], current['files']
+        for label, names in (('new', set(new) - set(old)),
+                             ('removed', set(old) - set(new)),
+                             ('changed', [n for n in new if n in old and new[n][2] != old[n][2]])):
+            if names:
+                changes.append('{0} files: {1}'.format(label, ', '.join(sorted(names))))
+
+        old, new = previous['config'], current['config']
+        keys = [k for k in set(old) | set(new) if old.get(k) != new.get(k)]
+        if keys:
+            changes.append('config changed: {0}'.format(', '.join(sorted(keys))))
+
+        if not changes and previous['hash'] != current['hash']:
+            changes.append('hash changed')
+        return changes
+
     @cached_property
     def canvas_size(self):
         """Return the width and height for this sprite canvas"""
@@ -236,6 +494,101 @@ class Sprite(ConfigurableFromFile):
                 height = y
         return round_up(width), round_up(height)
 
+    @cached_property
+    def canvas(self):
+        """Return a RGBA PIL image containing every image of this sprite
+        using the biggest ratio. Every image format uses it as source.
+
+        If there is a cache, the previous canvas of this sprite is reused
+        repainting only the images which changed or moved."""
+        previous = entries = None
+        if self.cache:
+            entries = dict(((i.cache_key,) + self.paste_position(i) + (i.width, i.height), i)
+                           for i in self.images)
+            previous = self.cache.get(('canvas', self.path))
+
+        if previous is not None and previous[1].size == self.canvas_size:
+            previous_entries, canvas = previous
+            canvas = canvas.copy()
+            for key, x, y, width, height in previous_entries - set(entries):
+                canvas.paste((0, 0, 0, 0), (x, y, x + width, y + height))
+            for entry in set(entries) - previous_entries:
+                canvas.paste(entries[entry].image, entry[1:3])
+                entries[entry].release()
+        else:
+            canvas = self.repaint_previous_canvas()
+            if canvas is None:
+                canvas = self.render((0, 0) + self.canvas_size, release=True)
+
+        if self.cache:
+            self.cache.put(('canvas', self.path), (frozenset(entries), canvas), canvas)
+        return canvas
+
+    def repaint_previous_canvas(self):
+        """Return the canvas of the previous build of this sprite with the
+        images which changed since then pasted again, or ``None`` if the
+        layout of the sprite isn't exactly the same.
+
+        The previous canvas is read from the biggest png sprite image, so it
+        can't be used if it was quantized using ``png8`` or ``png8_alpha``."""
+        previous = self.previous_manifest
+        if not previous or 'layout' not in previous:
+            return None
+        if any(self.config[key] for key in ImageFormat.lossy_config):
+            return None
+
+        current = json.loads(json.dumps(self.manifest))
+        if (previous['version'] != current['version'] or
+                previous['config'] != current['config'] or
+                previous['layout'] != current['layout']):
+            return None
+
+        try:
+            path = ImageFormat(sprite=self).output_path(self.max_ratio)
+            canvas = PILImage.open(path).convert('RGBA')
+        except IOError:
+            return None
+        if canvas.size != self.canvas_size:
+            return None
+
+        changed = [i for i in self.images
+                   if previous['files'][self.image_key(i)][2] != i.digest]
+        print "\tRepainting {0} of {1} images over the previous canvas".format(len(changed), len(self.images))
+        for image in changed:
+            canvas.paste(image.image, self.paste_position(image))
+            image.release()
+        return canvas
+
+    def paste_position(self, image):
+        """Return where ``image`` is pasted inside the canvas."""
+        return (round_up(image.x + (image.padding[3] + image.margin[3]) * self.max_ratio),
+                round_up(image.y + (image.padding[0] + image.margin[0]) * self.max_ratio))
+
+    def render(self, box, release=False):
+        """Return a RGBA PIL image containing the ``box`` area of this sprite
+        canvas using the biggest ratio. Only the images intersecting ``box``
+        are pasted.
+
+        :param box: ``(left, upper, right, lower)`` tuple.
+        :param release: free the decoded pixels of every image no area below
+                        ``box`` needs."""
+        left, top, right, bottom = box
+        canvas = PILImage.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+
+        # Paste the images inside the canvas
+        for image in self.images:
+            x, y = self.paste_position(image)
+            if x < right and y < bottom and x + image.width > left and y + image.height > top:
+                canvas.paste(image.image, (x - left, y - top))
+                if release and y + image.height <= bottom:
+                    image.release()
+        return canvas
+
+    def release(self):
+        """Free the canvas of this sprite once every format has been
+        built."""
+        self.__dict__.pop('canvas', None)
+
     def sprite_path(self, ratio=1.0):
         return self.config['ratio_{0}_output'.format(ratio)]
 
@@ -248,24 +601,33 @@ class Sprite(ConfigurableFromFile):
         If the folder doesn't contain any valid image it will raise
         :class:`~SourceImagesNotFoundError`
 
+        Files can be filtered using the ``include`` and ``exclude`` glob
+        patterns and ``.glueignore`` files.
+
         The list of images will be ordered using the desired ordering
         algorithm. The default is 'maxside'.
         """
         extensions = '|'.join(self.valid_extensions)
         extension_re = re.compile('.+\.(%s)$' % extensions, re.IGNORECASE)
-        files = sorted(os.listdir(self.path))
 
         images = []
-        for root, dirs, files in os.walk(self.path, followlinks=self.config['follow_links']):
-            for filename in sorted(files):
-                if not filename.startswith('.') and extension_re.match(filename):
-                    images.append(Image(path=os.path.join(root, filename), config=self.config))
-            if not self.config['recursive']:
-                break
+        for relpath, entry in discovery.walk(self.path,
+                                             recursive=self.config['recursive'],
+                                             follow_links=self.config['follow_links'],
+                                             include=self.config.get('include'),
+                                             exclude=self.config.get('exclude')):
+            if extension_re.match(entry.name):
+                images.append(Image(path=entry.path, config=self.config,
+                                    cache=self.cache, stat=entry.stat()))
 
         if not images:
             raise SourceImagesNotFoundError(self.path)
 
+        # Sorting the images needs their size, so start reading them in the
+        # background in the same order they were found.
+        if not self.cache:
+            self.prefetch(images)
+
         images = sorted(images, reverse=self.config['algorithm_ordering'][0] != '-')
 
         return images
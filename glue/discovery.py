@@ -0,0 +1,135 @@
+import os
+import stat
+import fnmatch
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Backport for Python 2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+IGNORE_FILENAME = '.glueignore'
+
+
+class Entry(object):
+    """Minimal version of the ``DirEntry`` objects returned by ``scandir``,
+    used if it isn't available. The result of every stat is kept."""
+
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+        self._stat = {}
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks not in self._stat:
+            self._stat[follow_symlinks] = (os.stat if follow_symlinks else os.lstat)(self.path)
+        return self._stat[follow_symlinks]
+
+    def _mode(self, follow_symlinks):
+        try:
+            return self.stat(follow_symlinks).st_mode
+        except OSError:
+            return 0
+
+    def is_dir(self, follow_symlinks=True):
+        return stat.S_ISDIR(self._mode(follow_symlinks))
+
+    def is_file(self, follow_symlinks=True):
+        return stat.S_ISREG(self._mode(follow_symlinks))
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self._mode(False))
+
+
+def split_patterns(value):
+    """Return the list of glob patterns in a comma separated string."""
+    if not value:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [p.strip() for p in value.split(',') if p.strip()]
+
+
+def matches(patterns, relpath):
+    """Return ``True`` if ``relpath`` matches any of the glob ``patterns``.
+    Patterns without ``/`` only need to match the name of the file."""
+    relpath = relpath.replace(os.sep, '/')
+    name = relpath.rsplit('/', 1)[-1]
+    return any(fnmatch.fnmatch(relpath if '/' in p else name, p.strip('/'))
+               for p in patterns)
+
+
+def list_entries(path):
+    """Return the visible entries inside ``path`` sorted by name, and the
+    patterns of its ``.glueignore`` file."""
+    if scandir is not None:
+        entries = list(scandir(path))
+    else:
+        entries = [Entry(path, name) for name in os.listdir(path)]
+
+    ignored = []
+    visible = []
+    for entry in entries:
+        if entry.name == IGNORE_FILENAME:
+            with open(entry.path) as f:
+                ignored = [l.strip() for l in f if l.strip() and not l.startswith('#')]
+        elif not entry.name.startswith('.'):
+            visible.append(entry)
+    return sorted(visible, key=lambda e: e.name), ignored
+
+
+def walk(path, recursive=True, follow_links=False, include=None, exclude=None):
+    """Yield ``(relpath, entry)`` for every visible file inside ``path``.
+
+    Files of every folder are yielded (sorted by name) before the ones of
+    its subfolders. Files are skipped if they don't match any ``include``
+    pattern or if they match any ``exclude`` pattern or any pattern inside
+    the ``.glueignore`` file of any of their folders. ``entry.stat()`` is
+    only called once for every file, so it can be reused by the caller.
+    """
+    include = split_patterns(include)
+    exclude = split_patterns(exclude)
+
+    def visit(folder, relfolder, ignores):
+        entries, ignored = list_entries(folder)
+        if ignored:
+            ignores = ignores + [(relfolder, ignored)]
+
+        def excluded(relpath):
+            if matches(exclude, relpath):
+                return True
+            for base, patterns in ignores:
+                if matches(patterns, os.path.relpath(relpath, base) if base else relpath):
+                    return True
+            return False
+
+        folders = []
+        for entry in entries:
+            relpath = os.path.join(relfolder, entry.name) if relfolder else entry.name
+            if excluded(relpath):
+                continue
+            if entry.is_dir():
+                if recursive and (follow_links or not entry.is_symlink()):
+                    folders.append((entry, relpath))
+            elif entry.is_file() and (not include or matches(include, relpath)):
+                yield relpath, entry
+
+        for entry, relpath in folders:
+            for result in visit(entry.path, relpath, ignores):
+                yield result
+
+    return visit(path, '', [])
+
+
+def find_folders(path, follow_links=False, exclude=None):
+    """Return the entries of every visible folder inside ``path`` not
+    matching any ``exclude`` pattern or any pattern inside its
+    ``.glueignore`` file."""
+    entries, ignored = list_entries(path)
+    exclude = split_patterns(exclude) + ignored
+    return [e for e in entries
+            if (e.is_dir() or (follow_links and e.is_symlink())) and not matches(exclude, e.name)]
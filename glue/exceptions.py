@@ -21,3 +21,14 @@ class SourceImagesNotFoundError(GlueError):
 class NoSpritesFoldersFoundError(GlueError):
     """Raised if no sprites folders could be found."""
     error_code = 5
+
+
+class MemoryLimitExceededError(GlueError):
+    """Raised if a sprite can't be built using the memory allowed by
+    --max-memory."""
+    error_code = 6
+
+
+class StaleOutputsError(GlueError):
+    """Raised by --check if any output file isn't up to date."""
+    error_code = 7
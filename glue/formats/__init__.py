@@ -6,6 +6,9 @@ from .jsonformat import JSONFormat
 from .caat import CAATFormat
 from .less import LessFormat
 from .scss import ScssFormat
+from .webp import WebPFormat
+from .avif import AVIFFormat
+from .jpg import JPEGFormat
 
 
 formats = {'css': CssFormat,
@@ -15,4 +18,7 @@ formats = {'css': CssFormat,
            'json': JSONFormat,
            'caat': CAATFormat,
            'less': LessFormat,
-           'scss': ScssFormat}
+           'scss': ScssFormat,
+           'webp': WebPFormat,
+           'avif': AVIFFormat,
+           'jpg': JPEGFormat}
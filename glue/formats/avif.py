@@ -0,0 +1,61 @@
+import os
+
+from PIL import Image as PILImage
+
+try:
+    # Registers the AVIF plugin in Pillow versions without native support
+    import pillow_avif
+except ImportError:
+    pass
+
+from .img import ImageFormat, pil_supports, build_exif, read_exif
+
+
+class AVIFFormat(ImageFormat):
+
+    extension = 'avif'
+    mimetype = 'image/avif'
+    streaming = False
+    stores_manifest = False
+
+    # AVIF encoder speed used by every --png-profile.
+    speeds = {'fast': 10, 'balanced': 6, 'max': 0}
+
+    hash_config = ('png_profile', 'avif_quality')
+
+    @classmethod
+    def populate_argument_parser(cls, parser):
+        group = parser.add_argument_group("AVIF format options")
+
+        group.add_argument("--avif",
+                           dest="avif_dir",
+                           nargs='?',
+                           const=True,
+                           default=os.environ.get('GLUE_AVIF', False),
+                           metavar='DIR',
+                           help="Generate AVIF sprite images and optionally where")
+
+        group.add_argument("--avif-quality",
+                           dest="avif_quality",
+                           type=int,
+                           metavar='N',
+                           default=os.environ.get('GLUE_AVIF_QUALITY', 75),
+                           help="AVIF quality (0-100) (default: 75)")
+
+    @classmethod
+    def apply_parser_contraints(cls, parser, options):
+        if not pil_supports('AVIF'):
+            parser.error(("--avif requires a Pillow version with AVIF support "
+                          "or pillow-avif-plugin."))
+
+    def read_metadata(self, path):
+        return read_exif(PILImage.open(path).info['exif'])
+
+    def encode(self, canvas, output):
+        profile = self.sprite.config['png_profile']
+        quality = int(self.sprite.config['avif_quality'])
+        canvas.save(output, 'AVIF',
+                    quality=quality,
+                    speed=self.speeds[profile],
+                    exif=build_exif(self.metadata))
+        return "'{0}' profile (quality {1})".format(profile, quality)
@@ -6,7 +6,7 @@ import textwrap
 
 from jinja2 import Template
 
-from glue.helpers import round_up, nearest_fration
+from glue.helpers import round_up, nearest_fration, makedirs, atomic_write
 from glue import __version__
 
 
@@ -15,6 +15,14 @@ class BaseFormat(object):
     extension = None
     build_per_ratio = False
 
+    # Whether the output files store the hash of the sprite, so --plan and
+    # --check can tell if they are up to date.
+    checkable = True
+
+    # Config keys the output of this format depends on besides the hash of
+    # the sprite, so changing them only rebuilds the formats using them.
+    hash_config = ()
+
     def __init__(self, sprite):
         self.sprite = sprite
 
@@ -44,8 +52,25 @@ class BaseFormat(object):
     def save(self, *args, **kwargs):
         raise NotImplementedError
 
+    def outputs(self):
+        """Return the path of every file this format writes."""
+        if self.build_per_ratio:
+            return [self.output_path(ratio) for ratio in self.sprite.config['ratios']]
+        return [self.output_path()]
+
+    @property
+    def hash(self):
+        """Return a hash of everything the output of this format depends
+        on: the hash of the sprite and the settings in ``hash_config``."""
+        return self.sprite.config_hash(self.hash_config, self.sprite.hash)
+
+    def is_current(self, path):
+        """Return ``True`` if the file at ``path`` was built using the current
+        hash of this format. Formats not storing the hash are always rebuilt."""
+        return False
+
     def needs_rebuild(self):
-        return True
+        return not all(self.is_current(path) for path in self.outputs())
 
     def validate(self):
         pass
@@ -73,11 +98,19 @@ class BaseFormat(object):
 
 class BaseTextFormat(BaseFormat):
 
+    @property
+    def hash(self):
+        # Text formats refer to the sprite images by name and relative path
+        keys = ('{0}_dir'.format(self.format_label), '{0}_template'.format(self.format_label),
+                'img_dir', 'css_cachebuster_filename', 'css_cachebuster_only_sprites')
+        return self.sprite.config_hash(keys + self.hash_config, self.sprite.hash, self.sprite.name)
+
     def get_context(self, *args, **kwargs):
         sprite_path = os.path.relpath(self.sprite.sprite_path(), self.output_dir())
         sprite_path = self.fix_windows_path(sprite_path)
         context = {'version': __version__,
                    'hash': self.sprite.hash,
+                   'format_hash': self.hash,
                    'name': self.sprite.name,
                    'sprite_path': sprite_path,
                    'sprite_filename': os.path.basename(sprite_path),
@@ -134,29 +167,23 @@ class BaseTextFormat(BaseFormat):
 
     def save(self, *args, **kwargs):
         # Create the destination directory if required
-        if not os.path.exists(self.output_dir(*args, **kwargs)):
-            os.makedirs(self.output_dir(*args, **kwargs))
+        makedirs(self.output_dir(*args, **kwargs))
 
-        with codecs.open(self.output_path(*args, **kwargs), 'w', 'utf-8-sig') as f:
-            f.write(self.render(*args, **kwargs))
+        content = self.render(*args, **kwargs)
+        with atomic_write(self.output_path(*args, **kwargs)) as f:
+            f.write(codecs.BOM_UTF8 + content.encode('utf-8'))
 
 
 class BaseJSONFormat(BaseTextFormat):
 
     meta_key = 'meta'
 
-    def needs_rebuild(self):
-        for ratio in self.sprite.config['ratios']:
-            json_path = self.output_path(ratio)
-            if os.path.exists(json_path):
-                with codecs.open(json_path, 'r', 'utf-8-sig') as f:
-                    try:
-                        data = json.loads(f.read())
-                        assert data[self.meta_key]['hash'] == self.sprite.hash
-                    except Exception:
-                        continue
-            return True
-        return False
+    def is_current(self, path):
+        try:
+            with codecs.open(path, 'r', 'utf-8-sig') as f:
+                return json.loads(f.read())[self.meta_key]['hash'] == self.hash
+        except Exception:
+            return False
 
     def render(self, *args, **kwargs):
         return json.dumps(self.get_context(*args, **kwargs))
@@ -170,17 +197,11 @@ class BasePlistFormat(BaseTextFormat):
         context = self.get_context(*args, **kwargs)
         return plistlib.writePlistToString(context)
 
-    def needs_rebuild(self):
-        for ratio in self.sprite.config['ratios']:
-            cocos2d_path = self.output_path(ratio)
-            if os.path.exists(cocos2d_path):
-                try:
-                    data = plistlib.readPlist(cocos2d_path)
-                    assert data[self.meta_key]['hash'] == self.sprite.hash
-                except Exception:
-                    continue
-            return True
-        return False
+    def is_current(self, path):
+        try:
+            return plistlib.readPlist(path)[self.meta_key]['hash'] == self.hash
+        except Exception:
+            return False
 
 
 class JinjaTextFormat(BaseTextFormat):
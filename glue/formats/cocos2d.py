@@ -26,7 +26,7 @@ class Cocos2dFormat(BasePlistFormat):
 
         data = {'frames': {},
                 'metadata': {'version': context['version'],
-                             'hash': context['hash'],
+                             'hash': context['format_hash'],
                              'size':'{{{width}, {height}}}'.format(**context['ratios'][ratio]),
                              'name': context['name'],
                              'format': 2,
@@ -12,14 +12,22 @@ class CssFormat(JinjaTextFormat):
 
     extension = 'css'
     camelcase_separator = 'camelcase'
+    # Alternative image formats offered using image-set() in order of
+    # preference. The png sprite is always used as fallback. JPEG isn't
+    # offered as browsers would prefer it even if it lost the transparency.
+    image_set_formats = ('avif', 'webp')
     css_pseudo_classes = set(['link', 'visited', 'active', 'hover', 'focus',
                               'first-letter', 'first-line', 'first-child',
                               'before', 'after'])
+    hash_config = ('css_namespace', 'css_sprite_namespace', 'css_url',
+                   'css_cachebuster', 'css_separator',
+                   'css_pseudo_class_separator')
 
     template = u"""
-        /* glue: {{ version }} hash: {{ hash }} */
+        /* glue: {{ version }} hash: {{ format_hash }} */
         {% for image in images %}.{{ image.label }}{{ image.pseudo }}{%- if not image.last %},{{"\n"}}{%- endif %}{%- endfor %} {
-            background-image: url('{{ sprite_path }}');
+            background-image: url('{{ sprite_path }}');{% if image_set %}
+            background-image: {{ image_set }};{% endif %}
             background-repeat: no-repeat;
         }
         {% for image in images %}
@@ -31,7 +39,8 @@ class CssFormat(JinjaTextFormat):
         {% endfor %}{% for r, ratio in ratios.iteritems() %}
         @media screen and (-webkit-min-device-pixel-ratio: {{ ratio.ratio }}), screen and (min--moz-device-pixel-ratio: {{ ratio.ratio }}), screen and (-o-min-device-pixel-ratio: {{ ratio.fraction }}), screen and (min-device-pixel-ratio: {{ ratio.ratio }}), screen and (min-resolution: {{ ratio.ratio }}dppx) {
             {% for image in images %}.{{ image.label }}{{ image.pseudo }}{% if not image.last %},{{"\n"}}    {% endif %}{% endfor %} {
-                background-image: url('{{ ratio.sprite_path }}');
+                background-image: url('{{ ratio.sprite_path }}');{% if ratio.image_set %}
+                background-image: {{ ratio.image_set }};{% endif %}
                 -webkit-background-size: {{ width }}px {{ height }}px;
                 -moz-background-size: {{ width }}px {{ height }}px;
                 background-size: {{ width }}px {{ height }}px;
@@ -128,15 +137,23 @@ class CssFormat(JinjaTextFormat):
         if sum(cachebusters) > 1:
             parser.error("You can't use --cachebuster, --cachebuster-filename or --cachebuster-filename-only-sprites at the same time.")
 
-    def needs_rebuild(self):
-        hash_line = '/* glue: %s hash: %s */\n' % (__version__, self.sprite.hash)
+    @property
+    def hash(self):
+        # image-set() depends on which alternative image formats are enabled
+        return self.sprite.config_hash((), super(CssFormat, self).hash, self.image_set())
+
+    def is_current(self, path):
+        hashes = [self.hash]
+        if self.sprite.config.get('{0}_template'.format(self.format_label)):
+            # Custom templates written for previous versions store the hash
+            # of the sprite using {{ hash }}.
+            hashes.append(self.sprite.hash)
+        hash_lines = ['/* glue: %s hash: %s */\n' % (__version__, h) for h in hashes]
         try:
-            with codecs.open(self.output_path(), 'r', 'utf-8-sig') as existing_css:
-                first_line = existing_css.readline()
-                assert first_line == hash_line
+            with codecs.open(path, 'r', 'utf-8-sig') as existing_css:
+                return existing_css.readline() in hash_lines
         except Exception:
-            return True
-        return False
+            return False
 
     def validate(self):
         class_names = [':'.join(self.generate_css_name(i.filename)) for i in self.sprite.images]
@@ -160,24 +177,43 @@ class CssFormat(JinjaTextFormat):
         for image in context['images']:
             image['label'], image['pseudo'] = self.generate_css_name(image['filename'])
 
-        if self.sprite.config['css_url']:
-            context['sprite_path'] = '{0}{1}'.format(self.sprite.config['css_url'], context['sprite_filename'])
-
-            for r, ratio in context['ratios'].iteritems():
-                ratio['sprite_path'] = '{0}{1}'.format(self.sprite.config['css_url'], ratio['sprite_filename'])
-
-        # Add cachebuster if required
-        if self.sprite.config['css_cachebuster']:
+        context['sprite_path'] = self.sprite_url(context['sprite_path'])
+        context['image_set'] = self.image_set()
 
-            def apply_cachebuster(path):
-                return "%s?%s" % (path, self.sprite.hash)
+        for r, ratio in context['ratios'].iteritems():
+            ratio['sprite_path'] = self.sprite_url(ratio['sprite_path'])
+            ratio['image_set'] = self.image_set(r)
 
-            context['sprite_path'] = apply_cachebuster(context['sprite_path'])
+        return context
 
-            for r, ratio in context['ratios'].iteritems():
-                ratio['sprite_path'] = apply_cachebuster(ratio['sprite_path'])
+    def sprite_url(self, path):
+        """Return the url this format will use to refer the sprite image
+        at ``path`` (relative to this format output directory)."""
+        if self.sprite.config['css_url']:
+            path = '{0}{1}'.format(self.sprite.config['css_url'], os.path.basename(path))
 
-        return context
+        # Add cachebuster if required
+        if self.sprite.config['css_cachebuster']:
+            path = "%s?%s" % (path, self.sprite.hash)
+        return path
+
+    def image_set(self, ratio=1.0):
+        """Return an image-set() offering every enabled image format listed
+        in ``image_set_formats`` and the png sprite as fallback. Return an
+        empty string if none of them is enabled."""
+        from glue.formats import formats, ImageFormat
+
+        enabled_formats = self.sprite.config.get('enabled_formats', [])
+        candidates = [formats[f] for f in self.image_set_formats if f in enabled_formats]
+        if not candidates:
+            return ''
+
+        images = []
+        for format_cls in candidates + [ImageFormat]:
+            path = os.path.relpath(format_cls(sprite=self.sprite).output_path(ratio), self.output_dir())
+            path = self.sprite_url(self.fix_windows_path(path))
+            images.append("url('{0}') type('{1}')".format(path, format_cls.mimetype))
+        return 'image-set({0})'.format(', '.join(images))
 
     def generate_css_name(self, filename):
         filename = filename.rsplit('.', 1)[0]
@@ -5,6 +5,7 @@ from .css import CssFormat
 class HtmlFormat(CssFormat):
 
     extension = 'html'
+    checkable = False
     template = u"""
         <html>
             <head><title>Glue Sprite Test Html</title>
@@ -53,8 +54,8 @@ class HtmlFormat(CssFormat):
         context['css_path'] = os.path.relpath(os.path.join(self.sprite.config['css_dir'], '{0}.css'.format(self.sprite.name)), self.output_dir())
         return context
 
-    def needs_rebuild(self):
-        return True
+    def is_current(self, path):
+        return False
 
     def validate(self):
         return True
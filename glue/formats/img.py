@@ -1,17 +1,114 @@
 import os
+import sys
+import json
+import math
+import time
+import struct
+import zlib
+import inspect
+import multiprocessing
 
 from PIL import Image as PILImage
 from PIL import PngImagePlugin
 
 from glue import __version__
-from glue.helpers import round_up, cached_property
+from glue import png
+from glue.helpers import round_up, parse_size, makedirs, atomic_write
+from glue.exceptions import ValidationError
 from .base import BaseFormat
 
 
+# Hidden file next to the png sprite images storing the manifest of the
+# sprite.
+MANIFEST_FILENAME = '.{0}.glue-manifest'
+
+
+def pil_supports(format_name):
+    """Return ``True`` if this Pillow build is able to write ``format_name``
+    images."""
+    PILImage.init()
+    return format_name in PILImage.SAVE
+
+
+def pil_resize_box():
+    """Return ``True`` if this Pillow build is able to resize only a region
+    of an image (Pillow>=4.3)."""
+    return 'box' in inspect.getargspec(PILImage.Image.resize).args
+
+
+def build_exif(metadata):
+    """Return a minimal EXIF block (TIFF structure) storing glue metadata
+    as the ``Software`` and ``ImageDescription`` tags. Used by formats
+    without text chunks."""
+    metadata = dict(metadata)
+    tags = [(0x010e, metadata['Comment']), (0x0131, metadata['Software'])]
+
+    # Header, IFD entries count, 12 bytes per entry and next IFD offset.
+    offset = 8 + 2 + 12 * len(tags) + 4
+    entries, values = [], []
+    for tag, value in tags:
+        value = str(value) + '\0'
+        entries.append(struct.pack('<HHII', tag, 2, len(value), offset))
+        values.append(value)
+        offset += len(value)
+    return ''.join(['II*\0', struct.pack('<IH', 8, len(tags))] +
+                   entries + [struct.pack('<I', 0)] + values)
+
+
+def read_exif(data):
+    """Return the glue metadata stored by :func:`build_exif`."""
+    if data.startswith('Exif\0\0'):
+        data = data[6:]
+    names = {0x010e: 'Comment', 0x0131: 'Software'}
+    offset, = struct.unpack('<I', data[4:8])
+    count, = struct.unpack('<H', data[offset:offset + 2])
+    metadata = {}
+    for i in range(count):
+        entry = offset + 2 + i * 12
+        tag, kind, length, value_offset = struct.unpack('<HHII', data[entry:entry + 12])
+        if tag in names:
+            metadata[names[tag]] = data[value_offset:value_offset + length].rstrip('\0')
+    return metadata
+
+
 class ImageFormat(BaseFormat):
 
     build_per_ratio = True
     extension = 'png'
+    mimetype = 'image/png'
+
+    # Encoder settings used by every --png-profile. ``compress_type`` is the
+    # zlib strategy Pillow will use while deflating the image data.
+    png_profiles = {'fast': dict(compress_level=1,
+                                 compress_type=png.Z_RLE,
+                                 optimize=False),
+                    'balanced': dict(compress_level=6,
+                                     compress_type=zlib.Z_DEFAULT_STRATEGY,
+                                     optimize=False),
+                    'max': dict(compress_level=9,
+                                compress_type=zlib.Z_FILTERED,
+                                optimize=True)}
+
+    # Pillow quantizers able to handle RGBA images, in order of preference:
+    # libimagequant (only if Pillow was compiled with it) and fast octree.
+    png8_quantizers = (3, 2)
+
+    # Whether this format can be written one band of rows at a time.
+    streaming = True
+
+    # Options that need the whole canvas in memory.
+    streaming_conflicts = ('png8', 'png8_alpha', 'png_optimize', 'png_reduce')
+
+    # Options quantizing the png images, which then can't be used as canvas
+    # of following builds.
+    lossy_config = ('png8', 'png8_alpha')
+
+    # Encoder settings which don't change the pixels of the sprite.
+    hash_config = ('png_profile', 'png_optimize', 'png_reduce')
+
+    # Whether this format stores the manifest of the sprite. Following
+    # builds use the biggest png image as previous canvas.
+    stores_manifest = True
 
     @classmethod
     def populate_argument_parser(cls, parser):
@@ -55,6 +152,69 @@ class ImageFormat(BaseFormat):
                            help=("The output image format will be png8 "
                                  "instead of png32"))
 
+        group.add_argument("--png8-alpha",
+                           action="store_true",
+                           dest="png8_alpha",
+                           default=os.environ.get('GLUE_PNG8_ALPHA', False),
+                           help=("The output image format will be png8 keeping "
+                                 "semi-transparent pixels"))
+
+        group.add_argument("--png-profile",
+                           dest="png_profile",
+                           type=unicode,
+                           metavar='NAME',
+                           default=os.environ.get('GLUE_PNG_PROFILE', 'balanced'),
+                           choices=['fast', 'balanced', 'max'],
+                           help=("PNG encoder profile: fast, balanced or max "
+                                 "(default: balanced)"))
+
+        group.add_argument("--png-optimize",
+                           dest="png_optimize",
+                           action="store_true",
+                           default=os.environ.get('GLUE_PNG_OPTIMIZE', False),
+                           help=("Run a lossless optimization pass over the "
+                                 "png files"))
+
+        group.add_argument("--png-reduce",
+                           dest="png_reduce",
+                           action="store_true",
+                           default=os.environ.get('GLUE_PNG_REDUCE', False),
+                           help=("Store png files using the smallest lossless "
+                                 "color type (RGB, grayscale or palette)"))
+
+        group.add_argument("--png-threads",
+                           dest="png_threads",
+                           type=int,
+                           metavar='N',
+                           default=int(os.environ.get('GLUE_PNG_THREADS', 1)),
+                           help=("Compress png files using N threads. Use 0 "
+                                 "to use one thread per CPU (default: 1)"))
+
+        group.add_argument("--streaming",
+                           dest="streaming",
+                           action="store_true",
+                           default=os.environ.get('GLUE_STREAMING', False),
+                           help=("Compose and compress png files in bands of "
+                                 "rows instead of keeping the whole sprite "
+                                 "in memory"))
+
+        group.add_argument("--band-height",
+                           dest="band_height",
+                           type=int,
+                           metavar='ROWS',
+                           default=int(os.environ.get('GLUE_BAND_HEIGHT', 512)),
+                           help=("Number of rows of every band while using "
+                                 "--streaming (default: 512)"))
+
+        group.add_argument("--max-memory",
+                           dest="max_memory",
+                           type=unicode,
+                           metavar='SIZE',
+                           default=os.environ.get('GLUE_MAX_MEMORY', None),
+                           help=("Maximum amount of memory (e.g. 512M or 2G) "
+                                 "building a sprite image can use. If required "
+                                 "--streaming will be used"))
+
         group.add_argument("--ratios",
                            dest="ratios",
                            type=unicode,
@@ -68,44 +228,250 @@ class ImageFormat(BaseFormat):
                            const='2,1',
                            help="Shortcut for --ratios=2,1")
 
+    @classmethod
+    def apply_parser_contraints(cls, parser, options):
+        if options.band_height < 1:
+            parser.error("--band-height must be a positive number of rows.")
+        if options.max_memory:
+            try:
+                assert parse_size(options.max_memory) > 0
+            except (ValueError, AssertionError):
+                parser.error("Invalid --max-memory size '{0}'.".format(options.max_memory))
+
     def output_filename(self, *args, **kwargs):
         filename = super(ImageFormat, self).output_filename(*args, **kwargs)
         if self.sprite.config['css_cachebuster_filename'] or self.sprite.config['css_cachebuster_only_sprites']:
             return '{0}_{1}'.format(filename, self.sprite.hash)
         return filename
 
-    def needs_rebuild(self):
-        for ratio in self.sprite.config['ratios']:
-            image_path = self.output_path(ratio)
-            try:
-                existing = PILImage.open(image_path)
-                assert existing.info['Software'] == 'glue-%s' % __version__
-                assert existing.info['Comment'] == self.sprite.hash
-                continue
-            except Exception:
-                return True
-        return False
-
-    @cached_property
-    def _raw_canvas(self):
-        # Create the sprite canvas
+    def validate(self):
+        if self.sprite.config['png_profile'] not in self.png_profiles:
+            raise ValidationError(("Error: Unknown png profile '{0}' for sprite "
+                                   "'{1}'.\n").format(self.sprite.config['png_profile'],
+                                                      self.sprite.name))
+
+        # sprite.conf can enable streaming too, so check it for every sprite
+        if self.sprite.config['streaming'] and self.streaming:
+            for option in self.streaming_conflicts:
+                if self.sprite.config[option]:
+                    raise ValidationError(("Error: --streaming can't be used together "
+                                           "with --{0} (sprite '{1}').\n").format(
+                                          option.replace('_', '-'), self.sprite.name))
+            if len(self.sprite.ratios) > 1 and not pil_resize_box():
+                raise ValidationError(("Error: --streaming several ratios requires "
+                                       "Pillow>=4.3 (sprite '{0}').\n").format(self.sprite.name))
+
+    @property
+    def metadata(self):
+        """Return the text metadata stored inside every sprite image."""
+        return [('Software', 'glue-%s' % __version__),
+                ('Comment', self.hash)]
+
+    def manifest_path(self):
+        """Return the path of the file storing the manifest of the sprite."""
+        return os.path.join(self.output_dir(), MANIFEST_FILENAME.format(self.sprite.name))
+
+    def save_manifest(self):
+        """Write the manifest of the sprite next to its images. It isn't
+        stored inside them, so sprite images only depend on their pixels."""
+        with atomic_write(self.manifest_path()) as f:
+            f.write(json.dumps(self.sprite.manifest, sort_keys=True))
+
+    def read_metadata(self, path):
+        """Return the glue metadata stored inside the image at ``path``."""
+        info = PILImage.open(path).info
+        return {'Software': info['Software'], 'Comment': info['Comment']}
+
+    def is_current(self, path):
+        try:
+            return self.read_metadata(path) == dict(self.metadata)
+        except Exception:
+            return False
+
+    def scaled_size(self, ratio):
+        """Return the size of the sprite canvas scaled using ``ratio``."""
+        width, height = self.sprite.canvas_size
+        return (round_up((width / self.sprite.max_ratio) * ratio),
+                round_up((height / self.sprite.max_ratio) * ratio))
+
+    def canvas(self, ratio):
+        """Return the sprite canvas scaled using ``ratio``."""
+        canvas = self.sprite.canvas
+
+        # If this canvas isn't the biggest one scale it using the ratio
+        if self.sprite.max_ratio != ratio:
+            canvas = canvas.resize(self.scaled_size(ratio), PILImage.ANTIALIAS)
+        return canvas
+
+    def canvas_bands(self, ratio):
+        """Yield the sprite canvas scaled using ``ratio`` as bands of at most
+        ``band_height`` rows. Only the area of the canvas every band needs is
+        rendered, so the whole canvas is never kept in memory."""
+        band_height = int(self.sprite.config['band_height'])
         width, height = self.sprite.canvas_size
-        canvas = PILImage.new('RGBA', (width, height), (0, 0, 0, 0))
+        size = self.scaled_size(ratio)
+
+        if self.sprite.max_ratio == ratio:
+            for top in xrange(0, height, band_height):
+                yield self.sprite.render((0, top, width, min(height, top + band_height)),
+                                         release=True)
+            return
+
+        # ANTIALIAS (Lanczos) reads up to three source rows per output row
+        # around every sample, so render those rows too.
+        scale = float(height) / size[1]
+        support = self._filter_support(scale)
+        for top in xrange(0, size[1], band_height):
+            bottom = min(size[1], top + band_height)
+            render_top = max(0, int(top * scale) - support)
+            render_bottom = min(height, int(math.ceil(bottom * scale)) + support)
+            band = self.sprite.render((0, render_top, width, render_bottom),
+                                      release=True)
+            yield band.resize((size[0], bottom - top), PILImage.ANTIALIAS,
+                              box=(0, top * scale - render_top,
+                                   width, bottom * scale - render_top))
+
+    def _filter_support(self, scale):
+        """Return how many source rows around every sample ANTIALIAS
+        (Lanczos) reads while downscaling using ``scale``."""
+        return int(math.ceil(3 * scale)) + 1
+
+    def can_stream(self, image_formats):
+        """Return ``True`` if every format in ``image_formats`` can be built
+        using ``streaming``."""
+        return (all(f.streaming for f in image_formats) and
+                not any(self.sprite.config[o] for o in self.streaming_conflicts) and
+                (len(self.sprite.ratios) == 1 or pil_resize_box()))
+
+    def memory_usage(self, streaming=False):
+        """Return an estimation of the peak amount of memory (in bytes)
+        required to build the images of this sprite.
+
+        Source images are released right after being pasted, so only one of
+        them (plus its RGBA copy) is decoded at a time. Next to the canvas (or
+        band) there is at most a working copy of the same size: either a
+        scaled version of it or the buffer of the encoder."""
+        usage = max(i.original_width * i.original_height for i in self.sprite.images) * 4 * 2
+        width, height = self.sprite.canvas_size
+
+        if not streaming:
+            return usage + width * height * 4 * 2
+
+        band_height = int(self.sprite.config['band_height'])
+        rows = min(height, band_height)
+        for ratio in self.sprite.ratios:
+            if ratio != self.sprite.max_ratio:
+                scale = float(height) / self.scaled_size(ratio)[1]
+                rows = max(rows, min(height, int(math.ceil(band_height * scale)) +
+                                             self._filter_support(scale) * 2 + 1))
+        return usage + width * rows * 4 * 2
+
+    def save(self, ratio):
+        # Create the destination directory if required
+        makedirs(self.output_dir(ratio=ratio))
+
+        image_path = self.output_path(ratio=ratio)
+
+        start = time.time()
+        output = atomic_write(image_path)
+        with output as f:
+            if self.sprite.config['streaming'] and self.streaming:
+                encoder = self.encode_bands(ratio, f)
+            else:
+                encoder = self.encode(self.canvas(ratio), f)
+
+        # Write the whole line at once as ratios may be encoded concurrently
+        sys.stdout.write("\t{0} encoded using {1}: {2} bytes in {3:.3f}s{4}\n".format(
+            os.path.basename(image_path), encoder,
+            os.path.getsize(image_path), time.time() - start,
+            '' if output.changed else ' (unchanged)'))
+
+        if self.stores_manifest and ratio == self.sprite.max_ratio:
+            self.save_manifest()
 
-        # Paste the images inside the canvas
-        for image in self.sprite.images:
-            canvas.paste(image.image,
-                (round_up(image.x + (image.padding[3] + image.margin[3]) * self.sprite.max_ratio),
-                 round_up(image.y + (image.padding[0] + image.margin[0]) * self.sprite.max_ratio)))
+    def encode_bands(self, ratio, output):
+        """Write the sprite canvas scaled using ``ratio`` into the file
+        ``output`` one band at a time. Return a description of the encoder settings
+        used."""
+        profile = self.sprite.config['png_profile']
+        threads = int(self.sprite.config['png_threads']) or multiprocessing.cpu_count()
+        kwargs = dict(level=self.png_profiles[profile]['compress_level'],
+                      strategy=self.png_profiles[profile]['compress_type'])
+
+        if threads == 1:
+            writer_cls = png.PNGWriter
+        else:
+            writer_cls = png.ParallelPNGWriter
+            kwargs['threads'] = threads
+
+        writer = writer_cls(output, self.scaled_size(ratio), 'RGBA', self.metadata, **kwargs)
+        for band in self.canvas_bands(ratio):
+            writer.write(band)
+        writer.close()
+        return "'{0}' profile streaming bands of {1} rows".format(profile, self.sprite.config['band_height'])
+
+    def encode(self, canvas, output):
+        """Write ``canvas`` into the file ``output``. Return a description of the
+        encoder settings used."""
+        profile = self.sprite.config['png_profile']
+        threads = int(self.sprite.config['png_threads']) or multiprocessing.cpu_count()
 
         meta = PngImagePlugin.PngInfo()
-        meta.add_text('Software', 'glue-%s' % __version__)
-        meta.add_text('Comment', self.sprite.hash)
+        for key, value in self.metadata:
+            meta.add_text(key, value, zip=len(value) > png.ZTXT_MIN_LENGTH)
 
         # Customize how the png is going to be saved
-        kwargs = dict(optimize=False, pnginfo=meta)
+        kwargs = dict(pnginfo=meta)
+        kwargs.update(self.png_profiles[profile])
+
+        canvas, kwargs = self._to_palette(canvas, kwargs)
+
+        if self.sprite.config['png_optimize']:
+            canvas = png.clear_transparent_pixels(canvas)
+
+        if self.sprite.config['png_reduce'] or self.sprite.config['png_optimize']:
+            canvas, transparency = png.reduce_color_type(canvas)
+            if transparency:
+                kwargs['transparency'] = transparency
+
+        if self.sprite.config['png_optimize']:
+            output.write(self._optimize(canvas, kwargs))
+            return 'optimization pass'
+
+        if threads != 1:
+            palette, transparency = self._png_palette(canvas, kwargs)
+            png.write(output, canvas, self.metadata, palette, transparency,
+                      threads=threads,
+                      level=self.png_profiles[profile]['compress_level'],
+                      strategy=self.png_profiles[profile]['compress_type'])
+            return "'{0}' profile and {1} threads".format(profile, threads)
+
+        canvas.save(output, 'PNG', **kwargs)
+        return "'{0}' profile".format(profile)
+
+    def _to_palette(self, canvas, kwargs):
+        """Convert the canvas to palette mode if required by either
+        ``png8`` or ``png8_alpha``. Returns the new canvas and png kwargs."""
+        kwargs = dict(kwargs)
 
-        if self.sprite.config['png8']:
+        if self.sprite.config['png8_alpha']:
+            # Make every fully transparent pixel share the same color so all
+            # of them end up using the same palette entry.
+            canvas = png.clear_transparent_pixels(canvas)
+
+            for method in self.png8_quantizers:
+                try:
+                    canvas = canvas.quantize(colors=256, method=method)
+                    break
+                except ValueError:
+                    # This quantizer isn't available in this Pillow build
+                    continue
+
+            # tRNS only needs the alpha of the entries up to the last non
+            # opaque one.
+            kwargs['transparency'] = canvas.im.getpalette('RGBA', 'A').rstrip('\xff')
+
+        elif self.sprite.config['png8']:
             # Get the alpha band
             alpha = canvas.split()[-1]
             canvas = canvas.convert('RGB'
@@ -121,27 +487,23 @@ class ImageFormat(BaseFormat):
             kwargs.update({'transparency': 255})
         return canvas, kwargs
 
-    def save(self, ratio):
-        width, height = self.sprite.canvas_size
-        canvas, kwargs = self._raw_canvas
-
-        # Loop all over the ratios and save one image for each one
-        for ratio in self.sprite.config['ratios']:
-
-            # Create the destination directory if required
-            if not os.path.exists(self.output_dir(ratio=ratio)):
-                os.makedirs(self.output_dir(ratio=ratio))
-
-            image_path = self.output_path(ratio=ratio)
+    def _png_palette(self, canvas, kwargs):
+        """Return the PLTE and tRNS payloads :mod:`glue.png` needs in order
+        to write this canvas."""
+        palette = transparency = None
+        if canvas.mode == 'P':
+            # Only store the palette entries in use
+            entries = canvas.getextrema()[1] + 1
+            palette = canvas.getpalette()[:entries * 3]
+            transparency = kwargs.get('transparency')
+            if isinstance(transparency, int):
+                transparency = '\xff' * transparency + '\x00'
+            if transparency:
+                transparency = transparency[:entries]
+        return palette, transparency
 
-            # If this canvas isn't the biggest one scale it using the ratio
-            if self.sprite.max_ratio != ratio:
-
-                reduced_canvas = canvas.resize(
-                                    (round_up((width / self.sprite.max_ratio) * ratio),
-                                     round_up((height / self.sprite.max_ratio) * ratio)),
-                                     PILImage.ANTIALIAS)
-                reduced_canvas.save(image_path, **kwargs)
-                # TODO: Use Imagemagick if it's available
-            else:
-                canvas.save(image_path, **kwargs)
+    def _optimize(self, canvas, kwargs):
+        """Return the smallest png representation of this canvas."""
+        palette, transparency = self._png_palette(canvas, kwargs)
+        return png.optimize(canvas, self.metadata, palette, transparency,
+                            pnginfo=kwargs['pnginfo'])
@@ -0,0 +1,52 @@
+import os
+
+from PIL import Image as PILImage
+
+from .img import ImageFormat, build_exif, read_exif
+
+
+class JPEGFormat(ImageFormat):
+
+    extension = 'jpg'
+    mimetype = 'image/jpeg'
+    streaming = False
+    stores_manifest = False
+
+    hash_config = ('png_profile', 'jpg_quality')
+
+    @classmethod
+    def populate_argument_parser(cls, parser):
+        group = parser.add_argument_group("JPEG format options")
+
+        group.add_argument("--jpg",
+                           dest="jpg_dir",
+                           nargs='?',
+                           const=True,
+                           default=os.environ.get('GLUE_JPG', False),
+                           metavar='DIR',
+                           help="Generate JPEG sprite images and optionally where")
+
+        group.add_argument("--jpg-quality",
+                           dest="jpg_quality",
+                           type=int,
+                           metavar='N',
+                           default=os.environ.get('GLUE_JPG_QUALITY', 85),
+                           help="JPEG quality (0-100) (default: 85)")
+
+    def read_metadata(self, path):
+        return read_exif(PILImage.open(path).info['exif'])
+
+    def encode(self, canvas, output):
+        profile = self.sprite.config['png_profile']
+        quality = int(self.sprite.config['jpg_quality'])
+
+        # JPEG doesn't support transparency, use a white background.
+        background = PILImage.new('RGB', canvas.size, (255, 255, 255))
+        background.paste(canvas, mask=canvas.split()[-1])
+
+        background.save(output, 'JPEG',
+                        quality=quality,
+                        optimize=profile != 'fast',
+                        progressive=profile == 'max',
+                        exif='Exif\0\0' + build_exif(self.metadata))
+        return "'{0}' profile (quality {1})".format(profile, quality)
@@ -9,6 +9,7 @@ class JSONFormat(BaseJSONFormat):
 
     extension = 'json'
     build_per_ratio = True
+    hash_config = ('json_format',)
 
     @classmethod
     def populate_argument_parser(cls, parser):
@@ -48,7 +49,7 @@ class JSONFormat(BaseJSONFormat):
                                                        'h': i['original_height']}}] for i in context['images']])
 
         data = dict(frames=None, meta={'version': context['version'],
-                                       'hash': context['hash'],
+                                       'hash': context['format_hash'],
                                        'name': context['name'],
                                        'sprite_path': context['sprite_path'],
                                        'sprite_filename': context['sprite_filename'],
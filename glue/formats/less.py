@@ -7,16 +7,18 @@ class LessFormat(CssFormat):
 
     extension = 'less'
     template = u"""
-        /* glue: {{ version }} hash: {{ hash }} */
+        /* glue: {{ version }} hash: {{ format_hash }} */
         {% for image in images %}.{{ image.label }}{{ image.pseudo }}{%- if not image.last %}, {%- endif %}{%- endfor %}{
-            background-image:url('{{ sprite_path }}');
+            background-image:url('{{ sprite_path }}');{% if image_set %}
+            background-image:{{ image_set }};{% endif %}
             background-repeat:no-repeat;
             -webkit-background-size: {{ width }}px {{ height }}px;
             -moz-background-size: {{ width }}px {{ height }}px;
             background-size: {{ width }}px {{ height }}px;
             {% for r, ratio in ratios.iteritems() %}
             @media screen and (-webkit-min-device-pixel-ratio: {{ ratio.ratio }}), screen and (min--moz-device-pixel-ratio: {{ ratio.ratio }}),screen and (-o-min-device-pixel-ratio: {{ ratio.fraction }}),screen and (min-device-pixel-ratio: {{ ratio.ratio }}),screen and (min-resolution: {{ ratio.ratio }}dppx){
-                background-image:url('{{ ratio.sprite_path }}');
+                background-image:url('{{ ratio.sprite_path }}');{% if ratio.image_set %}
+                background-image:{{ ratio.image_set }};{% endif %}
             }
             {% endfor %}
         }
@@ -0,0 +1,63 @@
+import os
+
+from PIL import Image as PILImage
+
+from .img import ImageFormat, pil_supports, build_exif, read_exif
+
+
+class WebPFormat(ImageFormat):
+
+    extension = 'webp'
+    mimetype = 'image/webp'
+    streaming = False
+    stores_manifest = False
+
+    # WebP encoder effort (method) used by every --png-profile.
+    methods = {'fast': 0, 'balanced': 4, 'max': 6}
+
+    hash_config = ('png_profile', 'webp_quality')
+
+    @classmethod
+    def populate_argument_parser(cls, parser):
+        group = parser.add_argument_group("WebP format options")
+
+        group.add_argument("--webp",
+                           dest="webp_dir",
+                           nargs='?',
+                           const=True,
+                           default=os.environ.get('GLUE_WEBP', False),
+                           metavar='DIR',
+                           help="Generate WebP sprite images and optionally where")
+
+        group.add_argument("--webp-quality",
+                           dest="webp_quality",
+                           type=int,
+                           metavar='N',
+                           default=os.environ.get('GLUE_WEBP_QUALITY', None),
+                           help=("Use lossy compression with this quality (0-100) "
+                                 "instead of lossless compression"))
+
+    @classmethod
+    def apply_parser_contraints(cls, parser, options):
+        if not pil_supports('WEBP'):
+            parser.error("--webp requires a Pillow version with WebP support.")
+
+    def read_metadata(self, path):
+        return read_exif(PILImage.open(path).info['exif'])
+
+    def encode(self, canvas, output):
+        profile = self.sprite.config['png_profile']
+        quality = self.sprite.config['webp_quality']
+
+        kwargs = dict(method=self.methods[profile],
+                      exif=build_exif(self.metadata))
+
+        if quality in (None, ''):
+            kwargs.update(lossless=True, quality=100)
+            compression = 'lossless'
+        else:
+            kwargs.update(quality=int(quality))
+            compression = 'quality {0}'.format(quality)
+
+        canvas.save(output, 'WEBP', **kwargs)
+        return "'{0}' profile ({1})".format(profile, compression)
@@ -1,8 +1,16 @@
 import os
 import sys
+import filecmp
+import tempfile
 import contextlib
 from StringIO import StringIO
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
 
 def round_up(value):
     int_value = int(value)
@@ -24,6 +32,135 @@ def nearest_fration(value):
         return '%i/100' % int(float(value) * 100)
 
 
+def makedirs(path):
+    """Create ``path`` and all its parents if they don't exist. Other threads
+    or processes may be creating them at the same time."""
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+# Permissions of new files, umask can only be read by changing it
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+class atomic_write(object):
+    """Context manager returning a file object to write the new content of
+    ``path``. The content is written into a temporary file which replaces
+    ``path`` once it is complete, so nobody ever reads a half-written file.
+
+    If the new content is the same as the current one, ``path`` isn't
+    touched at all (and ``changed`` is ``False``) so tools watching it aren't
+    triggered."""
+
+    def __init__(self, path, mode='wb'):
+        self.path = path
+        self.mode = mode
+        self.changed = None
+
+    def __enter__(self):
+        dirname, filename = os.path.split(self.path)
+        fd, self.tmp = tempfile.mkstemp(prefix='.{0}.'.format(filename), suffix='.tmp',
+                                        dir=dirname or '.')
+        self.file = os.fdopen(fd, self.mode)
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is not None:
+            os.remove(self.tmp)
+            return False
+
+        exists = os.path.isfile(self.path)
+        if exists and filecmp.cmp(self.tmp, self.path, shallow=False):
+            os.remove(self.tmp)
+            self.changed = False
+            return False
+
+        if exists:
+            os.chmod(self.tmp, os.stat(self.path).st_mode & 0o7777)
+        else:
+            os.chmod(self.tmp, 0o666 & ~UMASK)
+
+        # Windows can't rename over an existing file
+        if os.name == 'nt' and exists:
+            os.remove(self.path)
+        os.rename(self.tmp, self.path)
+        self.changed = True
+        return False
+
+
+def lock_path(path):
+    """Return the path of the lock file of ``path``."""
+    dirname, filename = os.path.split(path)
+    return os.path.join(dirname, '.{0}.lock'.format(filename))
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive advisory lock on ``path`` (which doesn't need to
+    exist) while the block runs. Other processes and threads trying to lock
+    the same path wait until it is released.
+
+    The lock file is removed once released. If other process removed it
+    while waiting for it, a new one is locked instead."""
+    if fcntl is None:
+        yield
+        return
+
+    filename = lock_path(path)
+    while True:
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(fd), os.stat(filename)):
+                break
+        except OSError:
+            pass
+        os.close(fd)
+
+    try:
+        yield
+    finally:
+        os.remove(filename)
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def file_locks(paths):
+    """Lock every path in ``paths``, always in the same order so processes
+    locking the same paths can't deadlock."""
+    paths = sorted(set(paths))
+    if not paths:
+        yield
+        return
+    with file_lock(paths[0]):
+        with file_locks(paths[1:]):
+            yield
+
+
+def parse_size(value):
+    """Return the number of bytes of a size like ``512M``, ``2G``, ``64K``
+    or ``1048576``."""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = str(value).strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def parse_shard(value):
+    """Return the ``(index, count)`` of a shard like ``2/4``. Shards are
+    numbered from 1."""
+    index, count = [int(v) for v in str(value).split('/')]
+    if not 1 <= index <= count:
+        raise ValueError(value)
+    return index, count
+
+
 class _Missing(object):
     """ Missing object necessary for cached_property"""
     def __repr__(self):
@@ -63,6 +200,8 @@ class cached_property(object):
 @contextlib.contextmanager
 def redirect_stdout(stream=None):
     stream = stream or StringIO()
-    sys.stdout = stream
-    yield
-    sys.stdout = sys.__stdout__
+    previous, sys.stdout = sys.stdout, stream
+    try:
+        yield
+    finally:
+        sys.stdout = previous
@@ -1,7 +1,31 @@
+import os
+import sys
 import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
 
 from glue.core import Sprite
-from glue.formats import formats
+from glue.cache import ArtifactCache
+from glue.formats import formats, ImageFormat
+from glue.helpers import redirect_stdout, parse_size, makedirs, file_locks
+from glue.exceptions import GlueError, StaleOutputsError
+
+
+def _build_sprite(args):
+    """Build the sprite at ``path`` using a new ``manager_cls`` manager.
+    Used by every process of :meth:`BaseManager.process_parallel`. Return the
+    output of the build, the :class:`~GlueError` raised, if any, and the
+    files written."""
+    manager_cls, config, path = args
+    manager = manager_cls(**config)
+    output = StringIO()
+    with redirect_stdout(output):
+        try:
+            manager.build_sprite(path)
+        except GlueError, e:
+            return output.getvalue(), e, manager.written
+    return output.getvalue(), None, manager.written
 
 
 class BaseManager(object):
@@ -10,11 +34,129 @@ class BaseManager(object):
         self.config = kwargs
         self.sprites = []
 
+        # ImageCache shared with previous builds (used by --watch)
+        self.cache = None
+
+        # Path of every output file written by this manager
+        self.written = []
+
     def process(self):
+        jobs = int(self.config['jobs']) or multiprocessing.cpu_count()
+        if jobs != 1:
+            return self.process_parallel(jobs)
+
+        if self.config['stream_sprites']:
+            # Build, save and release one sprite at a time. This way only
+            # one sprite needs to be in memory.
+            for path in self.find_sprite_paths():
+                self.build_sprite(path)
+            return
+
         self.find_sprites()
         self.validate()
         self.save()
 
+    def process_parallel(self, jobs):
+        """Build every sprite in a pool of ``jobs`` processes. The biggest
+        sprites are scheduled first, but the output of every sprite is
+        printed in the same order sprites are found."""
+        paths = list(self.find_sprite_paths())
+        if len(paths) == 1:
+            return self.build_sprite(paths[0])
+
+        pool = multiprocessing.Pool(min(jobs, len(paths)))
+        try:
+            results = {}
+            for path in sorted(paths, key=self.sprite_size, reverse=True):
+                results[path] = pool.apply_async(_build_sprite, [(self.__class__, self.config, path)])
+
+            for path in paths:
+                output, error, written = results[path].get()
+                sys.stdout.write(output)
+                self.written.extend(written)
+                if error:
+                    raise error
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def sprite_size(self, path):
+        """Return the size in bytes of every file inside the sprite at
+        ``path``. Used to estimate how long building it will take."""
+        size = 0
+        for root, dirs, files in os.walk(path, followlinks=self.config['follow_links']):
+            size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+            if not self.config['recursive']:
+                break
+        return size
+
+    def build_sprite(self, path):
+        """Create, validate and save the sprite at ``path``."""
+        sprite = self.create_sprite(path)
+        sprite.validate()
+        self.save_sprite(sprite)
+
+    def plan(self):
+        """Print, for every sprite and output file, if it is up to date or
+        which changes would make glue rebuild it. Images are neither decoded
+        nor written."""
+        for sprite, outputs in self.find_outputs():
+            if any(status not in ('up to date', 'always rebuilt') for _, _, status in outputs):
+                print "Sprite '{0}' needs rebuild:".format(sprite.name)
+                for change in sprite.changes():
+                    print "\t* {0}".format(change)
+            else:
+                print "Sprite '{0}' is up to date:".format(sprite.name)
+
+            for format_name, output, status in outputs:
+                print "\t{0}: {1} {2}".format(format_name, os.path.relpath(output), status)
+
+    def check(self):
+        """Make sure every output file is up to date without writing
+        anything. Raise :class:`~StaleOutputsError` listing the stale ones if
+        they aren't."""
+        stale = []
+        for sprite, outputs in self.find_outputs():
+            for format_name, output, status in outputs:
+                if status in ('stale', 'missing'):
+                    print "{0} is {1}".format(os.path.relpath(output), status)
+                    stale.append(output)
+        if stale:
+            raise StaleOutputsError(stale)
+
+    def find_outputs(self):
+        """Yield every sprite (without arranging its images) together with a
+        list of ``(format_name, path, status)`` for every output file."""
+        for path in self.find_sprite_paths():
+            with redirect_stdout():
+                sprite = self.create_sprite(path, layout=False)
+
+            outputs = []
+            for format_name in self.config['enabled_formats']:
+                format = formats[format_name](sprite=sprite)
+                for output in format.outputs():
+                    if not format.checkable:
+                        status = 'always rebuilt'
+                    elif not os.path.exists(output):
+                        status = 'missing'
+                    elif format.is_current(output):
+                        status = 'up to date'
+                    else:
+                        status = 'stale'
+                    outputs.append((format_name, output, status))
+            yield sprite, outputs
+
+    def create_sprite(self, path, layout=True):
+        """Return a new Sprite using this path.
+
+        :param path: Sprite path.
+        :param layout: arrange the images of the sprite.
+        """
+        return Sprite(path=path, config=self.config, layout=layout, cache=self.cache)
+
     def add_sprite(self, path):
         """Create a new Sprite using this path and name and append it to the
         sprites list.
@@ -22,12 +164,22 @@ class BaseManager(object):
         :param path: Sprite path.
         :param name: Sprite name.
         """
-        sprite = Sprite(path=path, config=self.config)
-        self.sprites.append(sprite)
+        self.sprites.append(self.create_sprite(path))
 
-    def find_sprites(self):
+    def find_sprite_paths(self):
+        """Yield the path of every sprite this manager needs to build."""
         raise NotImplementedError
 
+    def sprite_path_for(self, path):
+        """Return the path of the sprite a change on ``path`` affects,
+        ``None`` if it could affect all of them or ``False`` if it doesn't
+        affect any sprite this manager builds."""
+        return None
+
+    def find_sprites(self):
+        for path in self.find_sprite_paths():
+            self.add_sprite(path=path)
+
     def validate(self):
         """Validate all sprites inside this manager."""
 
@@ -37,13 +189,92 @@ class BaseManager(object):
     def save(self):
         """Save all sprites inside this manager."""
 
-        for format_name in self.config['enabled_formats']:
-            format_cls = formats[format_name]
-            for sprite in self.sprites:
-                format = format_cls(sprite=sprite)
-                format.validate()
-                if format.needs_rebuild() or sprite.config['force']:
-                    print "Format '{0}' for sprite '{1}' needs rebuild...".format(format_name, sprite.name)
+        for sprite in self.sprites:
+            self.save_sprite(sprite)
+
+    def save_sprite(self, sprite):
+        """Build every enabled format of ``sprite``.
+
+        Every output file is locked meanwhile, so other glue processes (or
+        threads) building the same files wait and find them up to date
+        instead of building them again."""
+
+        enabled = [(format_name, formats[format_name](sprite=sprite))
+                   for format_name in self.config['enabled_formats']]
+        for format_name, format in enabled:
+            format.validate()
+
+        outputs = [(n, path) for n, f in enabled for path in f.outputs()]
+        for format_name, path in outputs:
+            makedirs(os.path.dirname(path))
+
+        with file_locks(path for n, path in outputs):
+            self._save_sprite(sprite, enabled, outputs)
+
+    def _save_sprite(self, sprite, enabled, outputs):
+        threads = int(sprite.config['build_threads']) or multiprocessing.cpu_count()
+
+        artifacts = key = None
+        if sprite.config.get('artifact_cache'):
+            artifacts = ArtifactCache(sprite.config['artifact_cache'],
+                                      parse_size(sprite.config['artifact_cache_size']))
+            # Entries contain the outputs of every enabled format
+            key = sprite.config_hash((), *[n + f.hash for n, f in enabled])
+            if (not sprite.config['force'] and
+                    any(f.needs_rebuild() for n, f in enabled) and
+                    artifacts.restore(key, outputs)):
+                print "Sprite '{0}' restored from the artifact cache...".format(sprite.name)
+                self.written.extend(path for n, path in outputs)
+                return
+
+        pending = []
+        for format_name, format in enabled:
+            if format.needs_rebuild() or sprite.config['force']:
+                print "Format '{0}' for sprite '{1}' needs rebuild...".format(format_name, sprite.name)
+                if threads == 1:
                     format.build()
+                    self.written.extend(format.outputs())
                 else:
-                    print "Format '{0}'' for sprite '{1}' already exists...".format(format_name, sprite.name)
+                    pending.append(format)
+            else:
+                print "Format '{0}'' for sprite '{1}' already exists...".format(format_name, sprite.name)
+
+        if pending:
+            self.build_formats(sprite, pending, threads)
+            for format in pending:
+                self.written.extend(format.outputs())
+
+        # Every format of this sprite has been built, free its canvas
+        sprite.release()
+
+        if artifacts:
+            artifacts.store(key, outputs)
+
+    def build_formats(self, sprite, pending, threads):
+        """Build the ``pending`` formats of ``sprite`` in a pool of ``threads`` threads.
+
+        Text formats are rendered while the canvas of the sprite is composed,
+        and every ratio of every image format is encoded concurrently as soon
+        as the canvas is ready. Pillow and zlib release the GIL while doing
+        so."""
+        pool = ThreadPool(threads)
+        try:
+            tasks = []
+            image_formats = [f for f in pending if isinstance(f, ImageFormat)]
+            for format in pending:
+                if format not in image_formats:
+                    tasks.append(pool.apply_async(format.build))
+
+            # Unless every image format is streamed, they need the canvas
+            if any(not (sprite.config['streaming'] and f.streaming) for f in image_formats):
+                pool.apply_async(getattr, (sprite, 'canvas')).get()
+
+            for format in image_formats:
+                for ratio in sprite.config['ratios']:
+                    tasks.append(pool.apply_async(format.save, kwds={'ratio': ratio}))
+
+            for task in tasks:
+                task.get()
+        finally:
+            pool.close()
+            pool.join()
@@ -1,6 +1,9 @@
 import os
 
-from glue.exceptions import NoSpritesFoldersFoundError
+from glue import discovery
+from glue.core import Sprite
+from glue.helpers import parse_shard, cached_property
+from glue.exceptions import NoSpritesFoldersFoundError, StaleOutputsError
 from .base import BaseManager
 
 
@@ -10,22 +13,97 @@ class ProjectManager(BaseManager):
        This is not the default manager. It is only used if you use
        the ``--project`` argument."""
 
-    def find_sprites(self):
+    def find_sprite_paths(self):
+        """Yield the path of every sprite folder, or only the ones assigned
+        to this shard if ``shard`` is used."""
+        if not self.config.get('shard'):
+            for path in self.find_folders():
+                yield path
+            return
 
-        for filename in sorted(os.listdir(self.config['source'])):
+        index, count = parse_shard(self.config['shard'])
+        paths = list(self.find_folders())
+        shards = self.assign_shards(paths, count)
+        for path in paths:
+            if shards[path] == index:
+                yield path
 
-            # Only process folders
-            path = os.path.join(self.config['source'], filename)
+    def find_folders(self):
+        """Yield the path of every folder inside the source. Hidden folders,
+        folders matching ``exclude`` and folders listed in the
+        ``.glueignore`` file of the source are ignored."""
+        entries = discovery.find_folders(self.config['source'],
+                                         follow_links=self.config['follow_links'],
+                                         exclude=self.config.get('exclude'))
+        if not entries:
+            raise NoSpritesFoldersFoundError(self.config['source'])
 
-            # Ignore filenames starting with '.'
-            if filename.startswith('.'):
-                continue
+        for entry in entries:
+            yield entry.path
 
-            # Ignore symlinks if necessary.
-            if not os.path.isdir(path) and not (os.path.islink(path) and self.config['follow_links']):
-                continue
+    def assign_shards(self, paths, count):
+        """Return a dictionary with the shard (from 1 to ``count``) every
+        sprite in ``paths`` is built by.
 
-            self.add_sprite(path=path)
+        The biggest sprites are assigned first, each one to the shard with
+        the smallest amount of work so far. Every machine gets the same
+        assignment as long as the source images are the same."""
+        loads = [0] * count
+        shards = {}
+        sizes = dict((path, self.sprite_size(path)) for path in paths)
+        for path in sorted(paths, key=lambda p: (-sizes[p], os.path.basename(p))):
+            shard = loads.index(min(loads))
+            loads[shard] += sizes[path]
+            shards[path] = shard + 1
+        return shards
 
-        if not self.sprites:
-            raise NoSpritesFoldersFoundError(self.config['source'])
+    def merge_shards(self):
+        """Make sure the sprites of every one of the ``shard_merge`` shards
+        have been built and are up to date. Raise
+        :class:`~StaleOutputsError` if they aren't."""
+        count = int(self.config['shard_merge'])
+        shards = self.assign_shards(list(self.find_folders()), count)
+        sprites = [[] for _ in xrange(count)]
+        stale = [[] for _ in xrange(count)]
+        for sprite, outputs in self.find_outputs():
+            shard = shards[sprite.path] - 1
+            sprites[shard].append(sprite.name)
+            for format_name, output, status in outputs:
+                if status in ('stale', 'missing'):
+                    stale[shard].append(output)
+
+        for shard in xrange(count):
+            if stale[shard]:
+                print "Shard {0}/{1}: {2} output files are not up to date:".format(shard + 1, count, len(stale[shard]))
+                for output in stale[shard]:
+                    print "\t{0}".format(os.path.relpath(output))
+            else:
+                print "Shard {0}/{1}: {2} sprites up to date".format(shard + 1, count, len(sprites[shard]))
+
+        stale = sum(stale, [])
+        if stale:
+            raise StaleOutputsError(stale)
+
+    @cached_property
+    def sprite_paths(self):
+        """Return the set of sprite paths this manager builds. Watch mode
+        creates a new manager for every rebuild, so folders are only
+        searched once for every burst of changes."""
+        try:
+            return set(self.find_sprite_paths())
+        except NoSpritesFoldersFoundError:
+            return set()
+
+    def sprite_path_for(self, path):
+        relpath = os.path.relpath(path, self.config['source'])
+        folder = relpath.split(os.sep)[0]
+
+        # Project-level configuration and ignore files affect every sprite
+        if folder == os.pardir or relpath in (Sprite.config_filename, discovery.IGNORE_FILENAME):
+            return None
+
+        # Folders which are excluded or built by other shards are ignored
+        sprite_path = os.path.join(self.config['source'], folder)
+        if sprite_path in self.sprite_paths:
+            return sprite_path
+        return False
@@ -8,6 +8,9 @@ class SimpleManager(BaseManager):
     This is the default manager.
     """
 
-    def find_sprites(self):
-        self.add_sprite(path=self.config['source'])
+    def find_sprite_paths(self):
+        yield self.config['source']
+
+    def sprite_path_for(self, path):
+        return self.config['source']
 
@@ -1,8 +1,9 @@
-import os
 import sys
-import time
 import signal
-import hashlib
+
+from glue.cache import ImageCache
+from glue.helpers import parse_size
+from glue.watchers import get_watcher
 
 
 class WatchManager(object):
@@ -10,31 +11,44 @@ class WatchManager(object):
     def __init__(self, manager_cls, options):
         self.manager_cls = manager_cls
         self.options = options
-        self.last_hash = self.manager = None
+        self.watcher = None
+
+        # Keep images, layouts and canvases between rebuilds
+        self.cache = ImageCache(parse_size(options['watch_cache_size']))
         signal.signal(signal.SIGINT, self.signal_handler)
 
     def process(self):
+        self.watcher = get_watcher(self.options['source'], self.options['follow_links'])
+        self.create_manager().process()
         while True:
-            current_hash = self.generate_hash()
-            if self.last_hash != current_hash:
-                self.manager = self.manager_cls(**self.options)
-                self.manager.process()
-            self.last_hash = current_hash
-            time.sleep(0.2)
-
-    def generate_hash(self):
-        """ Return a hash of files and modification times to determine if a
-        change has occourred."""
-
-        hash_list = []
-        for root, dirs, files in os.walk(self.options['source']):
-            for f in sorted([f for f in files if not f.startswith('.')]):
-                hash_list.append(os.path.join(root, f))
-                hash_list.append(str(os.path.getmtime(os.path.join(root, f))))
-        hash_list = ''.join(hash_list)
-        return hashlib.sha1(hash_list).hexdigest()
+            self.rebuild(self.watcher.wait())
+
+    def rebuild(self, changes):
+        """Rebuild only the sprites affected by the changed paths in
+        ``changes``. Every sprite is rebuilt if ``changes`` is ``None`` or if
+        any of them affects all of them."""
+        manager = self.create_manager()
+
+        if changes is None:
+            return manager.process()
+
+        sprite_paths = set(manager.sprite_path_for(path) for path in changes)
+        if None in sprite_paths:
+            return manager.process()
+
+        for sprite_path in sorted(sprite_paths):
+            # Removed, excluded or other shards' sprites aren't built
+            if sprite_path:
+                manager.build_sprite(sprite_path)
+
+    def create_manager(self):
+        manager = self.manager_cls(**self.options)
+        manager.cache = self.cache
+        return manager
 
     def signal_handler(self, signal, frame):
         """ Gracefully close the app if Ctrl+C is pressed."""
         print 'You pressed Ctrl+C!'
+        if self.watcher:
+            self.watcher.close()
         sys.exit(0)
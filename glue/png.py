@@ -0,0 +1,410 @@
+import struct
+import zlib
+import StringIO
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from PIL import Image as PILImage
+from PIL import ImageChops
+
+SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# zlib.Z_RLE is only exported by Python >= 3.6
+Z_RLE = 3
+
+# PNG color type and bytes per pixel of every PIL mode this encoder handles.
+MODES = {'L': (0, 1),
+         'RGB': (2, 3),
+         'P': (3, 1),
+         'LA': (4, 2),
+         'RGBA': (6, 4)}
+
+# PNG filter types. ``adaptive`` chooses the best one for every scanline.
+FILTERS = {'none': 0, 'sub': 1, 'up': 2, 'average': 3}
+ADAPTIVE = 'adaptive'
+
+# zlib (level, strategy) pairs tried by :func:`optimize`.
+ZLIB_CONFIGS = ((9, zlib.Z_DEFAULT_STRATEGY),
+                (9, zlib.Z_FILTERED),
+                (9, Z_RLE),
+                (9, zlib.Z_HUFFMAN_ONLY))
+
+# Text values longer than this are stored as compressed zTXt chunks.
+ZTXT_MIN_LENGTH = 1024
+
+# Amount of raw image data compressed by every thread of
+# :class:`ParallelPNGWriter` at a time.
+BLOCK_SIZE = 512 * 1024
+
+# Used to estimate how well a filtered scanline will compress: the sum of the
+# filtered bytes interpreted as signed values (the libpng heuristic).
+SIGNED_ABS = [min(v, 256 - v) for v in range(256)]
+
+
+def chunk(tag, data=''):
+    """Return a PNG chunk containing ``data``."""
+    crc = zlib.crc32(tag + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', crc)
+
+
+def header_chunks(size, mode, text=(), palette=None, transparency=None):
+    """Return the signature and every chunk required before the image data.
+
+    :param text: list of ``(key, value)`` pairs to store as ``tEXt`` chunks
+                 (or compressed ``zTXt`` chunks if they are long).
+    :param palette: list of RGB values as returned by ``Image.getpalette``.
+    :param transparency: raw ``tRNS`` payload.
+    """
+    color_type = MODES[mode][0]
+    header = [SIGNATURE,
+              chunk('IHDR', struct.pack('>IIBBBBB', size[0], size[1], 8,
+                                        color_type, 0, 0, 0))]
+    for key, value in text:
+        if len(value) > ZTXT_MIN_LENGTH:
+            header.append(chunk('zTXt', '{0}\0\0{1}'.format(key, zlib.compress(value, 9))))
+        else:
+            header.append(chunk('tEXt', '{0}\0{1}'.format(key, value)))
+    if palette is not None:
+        header.append(chunk('PLTE', ''.join(map(chr, palette))))
+    if transparency:
+        header.append(chunk('tRNS', transparency))
+    return ''.join(header)
+
+
+def clear_transparent_pixels(image):
+    """Return a copy of ``image`` where the color of every fully transparent
+    pixel is black. Those pixels are invisible but their color would make the
+    image data harder to compress."""
+    if image.mode not in ('RGBA', 'LA'):
+        return image
+    mask = image.split()[-1].point(lambda a: 255 if a == 0 else 0)
+    image = image.copy()
+    image.paste((0,) * len(image.mode), mask=mask)
+    return image
+
+
+def reduce_color_type(image):
+    """Return the smallest lossless representation of a RGBA ``image`` and
+    the ``tRNS`` payload it requires (or ``None``).
+
+    Opaque images will use ``RGB`` or ``L`` (grayscale), images with up to
+    256 colors will use a palette with the exact same colors and grayscale
+    images with transparency will use ``LA``.
+    """
+    if image.mode != 'RGBA':
+        return image, None
+
+    red, green, blue, alpha = image.split()
+    opaque = alpha.getextrema() == (255, 255)
+    gray = (ImageChops.difference(red, green).getbbox() is None and
+            ImageChops.difference(green, blue).getbbox() is None)
+
+    if gray and opaque:
+        return red, None
+
+    colors = image.getcolors(256)
+    if colors is not None:
+        reduced = _exact_palette(image, colors)
+        if reduced is not None:
+            return reduced
+
+    if opaque:
+        return image.convert('RGB'), None
+    if gray:
+        return PILImage.merge('LA', (red, alpha)), None
+    return image, None
+
+
+def _exact_palette(image, colors):
+    """Return ``image`` converted to palette mode without losing any color
+    together with its ``tRNS`` payload, or ``None`` if it wasn't possible.
+
+    :param colors: colors of ``image`` as returned by ``Image.getcolors``.
+    """
+    alphas = {}
+    for count, color in colors:
+        alphas.setdefault(color[:3], set()).add(color[3])
+
+    if all(len(a) == 1 for a in alphas.itervalues()):
+        # Every color uses a single alpha value: build the palette using the
+        # RGB colors and add the alpha of every entry afterwards.
+        paletted = image.convert('RGB').convert('P', palette=PILImage.ADAPTIVE,
+                                                colors=len(alphas))
+        palette = paletted.getpalette()
+        entries = []
+        for i in range(0, len(palette), 3):
+            rgb = tuple(palette[i:i + 3])
+            entries.append(rgb + (list(alphas.get(rgb, [255]))[0],))
+    else:
+        paletted = image.quantize(colors=len(colors), method=2)
+        palette = map(ord, paletted.im.getpalette('RGBA', 'RGBA'))
+        entries = [tuple(palette[i:i + 4]) for i in range(0, len(palette), 4)]
+    entries += [(0, 0, 0, 255)] * (256 - len(entries))
+
+    # Make sure every pixel can be restored from the palette
+    indexes = PILImage.frombytes('L', image.size, paletted.tobytes())
+    restored = PILImage.merge('RGBA', [indexes.point([e[c] for e in entries]) for c in range(4)])
+    if ImageChops.difference(restored, image).getbbox() is not None:
+        return None
+
+    return paletted, ''.join(chr(e[3]) for e in entries).rstrip('\xff') or None
+
+
+def _shift(image, dx, dy):
+    """Return a copy of ``image`` moved ``dx`` columns to the right and ``dy``
+    rows down. The uncovered area is filled with zeroes."""
+    width, height = image.size
+    shifted = PILImage.new('L', image.size, 0)
+    if dx < width and dy < height:
+        shifted.paste(image.crop((0, 0, width - dx, height - dy)), (dx, dy))
+    return shifted
+
+
+def filter_scanlines(image, method=ADAPTIVE, previous=None):
+    """Return the PNG filtered scanlines of ``image`` (including the filter
+    type byte of every row).
+
+    The filters are computed using Pillow's channel operations over a
+    one-byte-per-sample view of the raw image data, so no Python code runs
+    per pixel. Paeth is not available as it can't be expressed using them.
+
+    :param method: one of :data:`FILTERS` or ``adaptive``.
+    :param previous: last raw scanline before ``image`` if ``image`` is a band
+                     of a bigger picture.
+    """
+    bpp = MODES[image.mode][1]
+    stride = image.size[0] * bpp
+    data = image.tobytes()
+    skip = 0
+    if previous is not None:
+        data = previous + data
+        skip = 1
+    height = len(data) // stride
+
+    raw = PILImage.frombytes('L', (stride, height), data)
+
+    candidates = {}
+    if method in ('none', ADAPTIVE):
+        candidates[FILTERS['none']] = raw
+    if method in ('sub', 'average', ADAPTIVE):
+        left = _shift(raw, bpp, 0)
+        if method != 'average':
+            candidates[FILTERS['sub']] = ImageChops.subtract_modulo(raw, left)
+    if method in ('up', 'average', ADAPTIVE):
+        up = _shift(raw, 0, 1)
+        if method != 'average':
+            candidates[FILTERS['up']] = ImageChops.subtract_modulo(raw, up)
+    if method in ('average', ADAPTIVE):
+        mean = ImageChops.add(left, up, scale=2)
+        candidates[FILTERS['average']] = ImageChops.subtract_modulo(raw, mean)
+
+    if not candidates:
+        raise ValueError("Unknown PNG filter method '{0}'".format(method))
+
+    if len(candidates) == 1:
+        filter_type, filtered = candidates.items()[0]
+        rows = [filter_type] * height
+    else:
+        # Estimate the cost of every filtered scanline and keep the cheapest.
+        costs = {}
+        resample = getattr(PILImage, 'BOX', PILImage.BILINEAR)
+        for filter_type, filtered in candidates.iteritems():
+            cost = filtered.point(SIGNED_ABS).convert('F')
+            costs[filter_type] = list(cost.resize((1, height), resample).getdata())
+        rows = [min(costs, key=lambda f: (costs[f][y], f)) for y in xrange(height)]
+
+    filtered = dict((f, candidates[f].tobytes()) for f in set(rows))
+    output = []
+    for y in xrange(skip, height):
+        output.append(chr(rows[y]))
+        output.append(filtered[rows[y]][y * stride:(y + 1) * stride])
+    return ''.join(output)
+
+
+class PNGWriter(object):
+    """Write a PNG image into ``fp`` one band of rows at a time.
+
+    Every call to :meth:`write` filters and compresses a PIL image with the
+    same width and mode than the final one. :meth:`close` must be called once
+    every row has been written.
+    """
+
+    def __init__(self, fp, size, mode, text=(), palette=None,
+                 transparency=None, level=6,
+                 strategy=zlib.Z_DEFAULT_STRATEGY, method=ADAPTIVE):
+        self.fp = fp
+        self.size = size
+        self.mode = mode
+        self.method = method
+        self.stride = size[0] * MODES[mode][1]
+        self._previous = None
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                            zlib.MAX_WBITS, 9, strategy)
+        self.fp.write(header_chunks(size, mode, text, palette, transparency))
+
+    def write(self, image):
+        data = filter_scanlines(image, self.method, self._previous)
+        self._previous = image.crop((0, image.size[1] - 1) + image.size).tobytes()
+        self._write_idat(self._compressor.compress(data))
+
+    def _write_idat(self, data):
+        if data:
+            self.fp.write(chunk('IDAT', data))
+
+    def close(self):
+        self._write_idat(self._compressor.flush())
+        self.fp.write(chunk('IEND'))
+
+
+def adler32_combine(adler1, adler2, length2):
+    """Return the adler32 checksum of two concatenated strings using their
+    checksums and the length of the second one (port of zlib's function, not
+    available in Python 2)."""
+    base = 65521
+    remainder = length2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (remainder * sum1) % base
+    sum1 += (adler2 & 0xffff) + base - 1
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + base - remainder
+    if sum1 >= base:
+        sum1 -= base
+    if sum1 >= base:
+        sum1 -= base
+    if sum2 >= base << 1:
+        sum2 -= base << 1
+    if sum2 >= base:
+        sum2 -= base
+    return sum1 | (sum2 << 16)
+
+
+def _deflate_band(args):
+    """Filter and deflate a band of rows as an independent raw deflate
+    stream ending on a byte boundary."""
+    image, previous, method, level, strategy = args
+    data = filter_scanlines(image, method, previous)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9, strategy)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return zlib.adler32(data) & 0xffffffff, len(data), compressed
+
+
+class ParallelPNGWriter(PNGWriter):
+    """Same as :class:`PNGWriter` but filtering and deflating independent
+    blocks of rows concurrently in a pool of threads. zlib releases the GIL
+    while compressing, so this scales with the number of cores.
+
+    Blocks are stitched into a single valid zlib stream the same way ``pigz``
+    does: every block ends with a sync flush, and the stream header and
+    adler32 trailer are written by the writer itself.
+    """
+
+    def __init__(self, fp, size, mode, text=(), palette=None,
+                 transparency=None, level=6,
+                 strategy=zlib.Z_DEFAULT_STRATEGY, method=ADAPTIVE,
+                 threads=None, block_size=BLOCK_SIZE):
+        super(ParallelPNGWriter, self).__init__(fp, size, mode, text, palette,
+                                                transparency, level, strategy,
+                                                method)
+        self.level = level
+        self.strategy = strategy
+        self.threads = threads or multiprocessing.cpu_count()
+        self.rows_per_block = max(1, block_size // self.stride)
+        self._pool = ThreadPool(self.threads)
+        self._jobs = collections.deque()
+        self._adler = 1
+        self._write_idat(self._zlib_header())
+
+    def _zlib_header(self):
+        # Deflate with a 32K window, plus the compression level hint.
+        cmf = 0x78
+        flg = (0 if self.level < 2 else 1 if self.level < 6 else 2 if self.level == 6 else 3) << 6
+        flg += (31 - (cmf * 256 + flg) % 31) % 31
+        return chr(cmf) + chr(flg)
+
+    def write(self, image):
+        width, height = image.size
+        for top in xrange(0, height, self.rows_per_block):
+            band = image.crop((0, top, width, min(height, top + self.rows_per_block)))
+            self._jobs.append(self._pool.apply_async(_deflate_band, [(band, self._previous, self.method, self.level, self.strategy)]))
+            self._previous = band.crop((0, band.size[1] - 1) + band.size).tobytes()
+
+            # Don't keep too many compressed blocks in memory
+            while len(self._jobs) > self.threads * 2:
+                self._write_block()
+
+    def _write_block(self):
+        adler, length, compressed = self._jobs.popleft().get()
+        self._adler = adler32_combine(self._adler, adler, length)
+        self._write_idat(compressed)
+
+    def close(self):
+        while self._jobs:
+            self._write_block()
+        self._pool.close()
+        self._pool.join()
+
+        # Empty final deflate block followed by the zlib stream trailer
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._write_idat(compressor.flush() + struct.pack('>I', self._adler))
+        self.fp.write(chunk('IEND'))
+
+
+def compress(data, level, strategy):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 9, strategy)
+    return compressor.compress(data) + compressor.flush()
+
+
+def write(fp, image, text=(), palette=None, transparency=None, threads=1, **kwargs):
+    """Write ``image`` as PNG into ``fp``. If ``threads`` is not ``1`` the
+    image data will be compressed using :class:`ParallelPNGWriter`."""
+    if threads == 1:
+        writer = PNGWriter(fp, image.size, image.mode, text, palette,
+                           transparency, **kwargs)
+    else:
+        writer = ParallelPNGWriter(fp, image.size, image.mode, text, palette,
+                                   transparency, threads=threads, **kwargs)
+    writer.write(image)
+    writer.close()
+
+
+def encode(image, *args, **kwargs):
+    """Return ``image`` encoded as PNG. Accepts the same arguments as
+    :func:`write`."""
+    output = StringIO.StringIO()
+    write(output, image, *args, **kwargs)
+    return output.getvalue()
+
+
+def optimize(image, text=(), palette=None, transparency=None, pnginfo=None):
+    """Return the smallest lossless PNG representation of ``image`` glue can
+    find.
+
+    Fully transparent pixels are cleared and every filter method is tried
+    using every zlib configuration in :data:`ZLIB_CONFIGS`. Pillow's own
+    encoder is also tried as it can use Paeth. Only the chunks glue needs are
+    written.
+
+    :param pnginfo: ``PngInfo`` with ``text`` for Pillow's encoder.
+    """
+    image = clear_transparent_pixels(image)
+
+    best = None
+    for method in [ADAPTIVE] + sorted(FILTERS):
+        data = filter_scanlines(image, method)
+        for level, strategy in ZLIB_CONFIGS:
+            compressed = compress(data, level, strategy)
+            if best is None or len(compressed) < len(best):
+                best = compressed
+
+    output = ''.join([header_chunks(image.size, image.mode, text, palette, transparency),
+                      chunk('IDAT', best),
+                      chunk('IEND')])
+
+    pillow_output = StringIO.StringIO()
+    kwargs = dict(optimize=True, pnginfo=pnginfo)
+    if transparency:
+        kwargs['transparency'] = transparency
+    image.save(pillow_output, 'PNG', **kwargs)
+    if len(pillow_output.getvalue()) < len(output):
+        return pillow_output.getvalue()
+    return output
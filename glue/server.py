@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import socket
+import urlparse
+import argparse
+import mimetypes
+import SocketServer
+import BaseHTTPServer
+
+from glue.batch import run_job
+from glue.cache import ImageCache
+from glue.helpers import parse_size
+from glue import __version__
+
+
+class BuildRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handle the requests of a :class:`~BuildServer`.
+
+    * ``POST /build`` builds the sprites described by the JSON body
+      ``{"args": ["source", "output", "--project", ...]}`` (the same
+      arguments ``glue`` accepts) and returns the status of the build.
+    * ``GET /status`` returns the status of the server.
+    * ``GET /<path>`` returns a file written by a previous build if the
+      server keeps them in memory.
+
+    Web pages are able to send requests to servers running in the machine
+    of the developer, so requests using an unknown ``Host`` (DNS rebinding)
+    or coming from other ``Origin`` are rejected, and builds must be
+    requested using ``Content-Type: application/json``, which browsers
+    can't send cross-site without asking first.
+    """
+
+    server_version = 'glue/{0}'.format(__version__)
+
+    def check_request(self):
+        """Return an error message if this request can't be trusted, or
+        ``None``."""
+        host = self.headers.get('Host')
+        if not self.server.valid_host(host):
+            return 'Invalid Host header'
+        origin = self.headers.get('Origin')
+        if origin is not None and urlparse.urlparse(origin).netloc != host:
+            return 'Cross-origin requests are not allowed'
+        return None
+
+    def do_POST(self):
+        if self.path != '/build':
+            return self.send_json(404, {'error': 'Not found'})
+
+        error = self.check_request()
+        if error:
+            return self.send_json(403, {'error': error})
+
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type != 'application/json':
+            return self.send_json(415, {'error': 'Content-Type must be application/json'})
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            args = json.loads(self.rfile.read(length))['args']
+        except (ValueError, KeyError, TypeError):
+            return self.send_json(400, {'error': 'Body must be {"args": [...]}'})
+
+        if (not isinstance(args, list) or
+                not all(isinstance(arg, basestring) for arg in args)):
+            return self.send_json(400, {'error': 'args must be a list of strings'})
+
+        result = self.server.build(args)
+        self.send_json(200 if result['status'] == 'ok' else 422, result)
+
+    def do_GET(self):
+        error = self.check_request()
+        if error:
+            return self.send_json(403, {'error': error})
+
+        if self.path == '/status':
+            return self.send_json(200, self.server.status())
+
+        path = self.path.split('?', 1)[0].lstrip('/')
+        if path not in self.server.files:
+            return self.send_json(404, {'error': 'Not found'})
+
+        data = self.server.files[path]
+        self.send_response(200)
+        self.send_header('Content-Type', mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets don't have a client address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return self.server.address
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            print "{0} - {1}".format(self.address_string(), format % args)
+
+
+class BuildServerMixin:
+    """Build sprites calling :func:`glue.bin.main` for every request.
+
+    Requests are handled one at a time, sharing an :class:`~ImageCache`, so
+    images, layouts and canvases are reused by following builds. If
+    ``memory`` is set, every file written is kept in memory and served under
+    its path relative to ``root``.
+    """
+
+    def setup_server(self, cache_size, memory=False, root=None, quiet=False):
+        self.cache = ImageCache(cache_size)
+        self.memory = memory
+        self.root = os.path.abspath(root or os.getcwd())
+        self.quiet = quiet
+        self.files = {}
+        self.builds = 0
+
+    def build(self, args):
+        """Run ``glue`` using ``args`` and return a dictionary with the
+        status, exit code, output, elapsed time and written files of the
+        build."""
+        result = run_job(args, self.cache)
+        self.builds += 1
+
+        outputs = []
+        for path in result['outputs']:
+            relpath = os.path.relpath(path, self.root)
+            outputs.append(relpath)
+            if self.memory:
+                with open(path, 'rb') as f:
+                    self.files[relpath] = f.read()
+        result['outputs'] = outputs
+
+        if not self.quiet:
+            print "Build {0} finished with code {1} in {2:.3f}s".format(self.builds, result['code'], result['time'])
+        return result
+
+    def status(self):
+        return {'version': __version__,
+                'builds': self.builds,
+                'cache_size': self.cache.size,
+                'files': sorted(self.files)}
+
+
+class BuildServer(BuildServerMixin, BaseHTTPServer.HTTPServer):
+
+    allow_reuse_address = True
+
+    # Host names accepted besides the address the server listens on
+    local_hosts = ('localhost', '127.0.0.1', '::1')
+
+    @property
+    def address(self):
+        return '{0}:{1}'.format(*self.server_address[:2])
+
+    def valid_host(self, host):
+        """Return ``True`` if requests using the ``Host`` header ``host`` are
+        addressed to this server."""
+        listen = self.server_address[0]
+        if host is None or listen in ('0.0.0.0', '::', ''):
+            # Clients without Host headers aren't browsers, and servers
+            # listening on every interface can be reached using any name.
+            return True
+        name = urlparse.urlparse('//' + host).hostname
+        return name in self.local_hosts or name == listen
+
+
+class UnixBuildServer(BuildServerMixin, SocketServer.UnixStreamServer):
+
+    def __init__(self, path, handler_cls):
+        # Remove the socket left by a previous server
+        if os.path.exists(path):
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, handler_cls)
+
+    @property
+    def address(self):
+        return self.server_address
+
+    def valid_host(self, host):
+        # Browsers can't connect to Unix sockets
+        return True
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def create_server(host='127.0.0.1', port=8123, unix_socket=None, cache_size='256M',
+                  memory=False, root=None, quiet=False):
+    """Return a :class:`~BuildServer` listening on ``host:port`` or, if
+    ``unix_socket`` is set, a :class:`~UnixBuildServer`."""
+    if unix_socket:
+        server = UnixBuildServer(unix_socket, BuildRequestHandler)
+    else:
+        server = BuildServer((host, port), BuildRequestHandler)
+    server.setup_server(parse_size(cache_size), memory=memory, root=root, quiet=quiet)
+    return server
+
+
+def serve(argv):
+    """Entry point of ``glue serve``."""
+    parser = argparse.ArgumentParser(prog='glue serve',
+                                     description="Keep glue running building sprites on request.")
+
+    parser.add_argument("--host",
+                        dest="host",
+                        default=os.environ.get('GLUE_SERVE_HOST', '127.0.0.1'),
+                        help="Interface to listen on (default: 127.0.0.1)")
+
+    parser.add_argument("--port",
+                        dest="port",
+                        type=int,
+                        default=int(os.environ.get('GLUE_SERVE_PORT', 8123)),
+                        help="Port to listen on (default: 8123)")
+
+    parser.add_argument("--socket",
+                        dest="unix_socket",
+                        metavar='PATH',
+                        default=os.environ.get('GLUE_SERVE_SOCKET', None),
+                        help="Listen on this Unix socket instead of a port")
+
+    parser.add_argument("--cache-size",
+                        dest="cache_size",
+                        metavar='SIZE',
+                        default=os.environ.get('GLUE_SERVE_CACHE_SIZE', '256M'),
+                        help=("Memory used to keep decoded images between "
+                              "builds (default: 256M)"))
+
+    parser.add_argument("--memory",
+                        dest="memory",
+                        action='store_true',
+                        default=os.environ.get('GLUE_SERVE_MEMORY', False),
+                        help="Keep the files written in memory and serve them")
+
+    parser.add_argument("--root",
+                        dest="root",
+                        default=os.environ.get('GLUE_SERVE_ROOT', None),
+                        help=("Files kept in memory are served relative to "
+                              "this folder (default: current folder)"))
+
+    parser.add_argument("-q", "--quiet",
+                        dest="quiet",
+                        action='store_true',
+                        default=os.environ.get('GLUE_SERVE_QUIET', False),
+                        help="Suppress all normal output")
+
+    options = parser.parse_args(argv)
+
+    try:
+        parse_size(options.cache_size)
+    except ValueError:
+        parser.error("Invalid --cache-size '{0}'.".format(options.cache_size))
+
+    try:
+        server = create_server(options.host, options.port, options.unix_socket,
+                               options.cache_size, options.memory, options.root,
+                               options.quiet)
+    except socket.error, e:
+        sys.stderr.write("Error: Unable to listen on {0}: {1}\n".format(
+                         options.unix_socket or '{0}:{1}'.format(options.host, options.port),
+                         e.strerror or e))
+        return 1
+
+    if not options.quiet:
+        print "glue {0} listening on {1}".format(__version__, server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
@@ -0,0 +1,213 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from glue import discovery
+
+
+# inotify(7) constants
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def is_watched(name):
+    """Return ``True`` unless ``name`` is hidden. ``.glueignore`` files are
+    watched too as they change which images are built."""
+    return name == discovery.IGNORE_FILENAME or not name.startswith('.')
+
+
+class BaseWatcher(object):
+    """Watch a folder (recursively) for changes.
+
+    :meth:`wait` blocks until something changes and returns the set of
+    changed paths. Bursts of changes (like a ``git checkout``) are returned
+    together once no new changes happen for ``debounce`` seconds.
+    """
+
+    # Returned by :meth:`wait` if the changed paths are unknown.
+    EVERYTHING = None
+
+    def __init__(self, path, follow_links=False, debounce=0.1):
+        self.path = path
+        self.follow_links = follow_links
+        self.debounce = debounce
+
+    def wait(self):
+        changes = set()
+        while changes is not self.EVERYTHING and not changes:
+            changes = self.changes(timeout=None)
+
+        while changes is not self.EVERYTHING:
+            more = self.changes(timeout=self.debounce)
+            if more is self.EVERYTHING:
+                return more
+            if not more:
+                break
+            changes |= more
+        return changes
+
+    def changes(self, timeout):
+        """Return the set of paths changed within ``timeout`` seconds (wait
+        forever if ``None``)."""
+        raise NotImplementedError
+
+    def walk(self):
+        """Yield ``(root, dirs, files)`` for every visible folder."""
+        for root, dirs, files in os.walk(self.path, followlinks=self.follow_links):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            yield root, dirs, [f for f in files if is_watched(f)]
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(BaseWatcher):
+    """Detect changes comparing the modification time of every file every
+    ``interval`` seconds. Used where inotify isn't available."""
+
+    interval = 0.2
+
+    def __init__(self, *args, **kwargs):
+        super(PollingWatcher, self).__init__(*args, **kwargs)
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        snapshot = {}
+        folders = set([self.path])
+        for relpath, entry in discovery.walk(self.path, follow_links=self.follow_links):
+            try:
+                snapshot[entry.path] = entry.stat().st_mtime
+            except OSError:
+                continue
+            folders.add(os.path.dirname(entry.path))
+
+        # discovery.walk reads but doesn't yield .glueignore files
+        for folder in folders:
+            path = os.path.join(folder, discovery.IGNORE_FILENAME)
+            try:
+                snapshot[path] = os.stat(path).st_mtime
+            except OSError:
+                continue
+        return snapshot
+
+    def changes(self, timeout):
+        start = time.time()
+        while True:
+            snapshot = self.take_snapshot()
+            changes = set(path for path in set(snapshot) | set(self.snapshot)
+                          if snapshot.get(path) != self.snapshot.get(path))
+            self.snapshot = snapshot
+            if changes or (timeout is not None and time.time() - start >= timeout):
+                return changes
+            time.sleep(self.interval)
+
+
+class InotifyWatcher(BaseWatcher):
+    """Receive changes from the Linux kernel using inotify (through ctypes),
+    so nothing needs to be done while nothing changes."""
+
+    mask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+
+    def __init__(self, *args, **kwargs):
+        super(InotifyWatcher, self).__init__(*args, **kwargs)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.folders = {}
+        for root, dirs, files in self.walk():
+            self.add_watch(root)
+
+    @classmethod
+    def available(cls):
+        if not sys.platform.startswith('linux'):
+            return False
+        library = ctypes.util.find_library('c')
+        return bool(library) and hasattr(ctypes.CDLL(library), 'inotify_init1')
+
+    def add_watch(self, path):
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = self.libc.inotify_add_watch(self.fd, path, self.mask)
+        if wd < 0:
+            # ENOSPC if fs.inotify.max_user_watches is too low, EACCES...
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), path)
+        self.folders[wd] = path
+
+    def changes(self, timeout):
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return set()
+            raise
+        if not readable:
+            return set()
+
+        changes = set()
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip('\0')
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # Some events were lost
+                return self.EVERYTHING
+            if mask & IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            if wd not in self.folders or not is_watched(name):
+                continue
+
+            path = os.path.join(self.folders[wd], name) if name else self.folders[wd]
+            if isinstance(self.path, unicode):
+                path = path.decode(sys.getfilesystemencoding())
+            changes.add(path)
+
+            # Watch new folders and everything inside them
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                for root, dirs, files in os.walk(path, followlinks=self.follow_links):
+                    dirs[:] = [d for d in dirs if not d.startswith('.')]
+                    try:
+                        self.add_watch(root)
+                    except OSError, e:
+                        # Changes inside this folder would go unnoticed
+                        sys.stderr.write("Warning: Unable to watch {0}: {1}.\n".format(root, e.strerror))
+                        return self.EVERYTHING
+                    changes.update(os.path.join(root, f) for f in files if is_watched(f))
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+def get_watcher(path, follow_links=False, debounce=0.1):
+    """Return the best watcher available in this platform."""
+    if InotifyWatcher.available():
+        try:
+            return InotifyWatcher(path, follow_links, debounce)
+        except OSError:
+            # Too many inotify instances or watches
+            pass
+    return PollingWatcher(path, follow_links, debounce)
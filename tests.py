@@ -1,9 +1,19 @@
 import os
+import re
 import sys
+import glob
+import hashlib
+import errno
 import json
 import codecs
 import shutil
+import signal
+import subprocess
+import socket
+import urllib2
 import unittest
+import threading
+import time
 import logging
 from StringIO import StringIO
 from plistlib import readPlist
@@ -13,8 +23,13 @@ import cssutils
 from mock import patch, Mock
 
 from glue.bin import main
+from glue.managers import ProjectManager
+from glue import png
+from glue import watchers as watchers_module
 from glue.core import Image
-from glue.helpers import redirect_stdout
+from glue.cache import ImageCache, ArtifactCache
+from glue.server import create_server
+from glue.helpers import redirect_stdout, file_lock
 
 
 RED = (255, 0, 0, 255)
@@ -291,6 +306,64 @@ class TestGlue(unittest.TestCase):
                         u'width': u'64px',
                         u'height': u'64px'})
 
+    def test_project_stream_sprites(self):
+        os.mkdir("sprites")
+        code = self.call("glue sprites output --project --stream-sprites")
+        self.assertEqual(code, 5)
+
+        self.create_image("sprites/icons/red.png", RED)
+        self.create_image("sprites/icons/blue.png", BLUE)
+        self.create_image("sprites/menu/green.png", GREEN)
+        self.create_image("sprites/menu/yellow.png", YELLOW)
+        code, output = self.call("glue sprites output --project --stream-sprites", capture=True)
+        self.assertEqual(code, 0)
+
+        # Every sprite is saved before the next one is processed
+        self.assertTrue(output.index("Format 'css' for sprite 'icons'") <
+                        output.index("Processing 'menu'"))
+
+        self.assertColor("output/icons.png", RED, ((0, 0), (63, 63)))
+        self.assertColor("output/icons.png", BLUE, ((64, 0), (127, 63)))
+        self.assertColor("output/menu.png", YELLOW, ((0, 0), (63, 63)))
+        self.assertColor("output/menu.png", GREEN, ((64, 0), (127, 63)))
+        self.assertCSS(u"output/menu.css", u'.sprite-menu-green',
+                       {u'background-image': u"url(menu.png)",
+                        u'background-repeat': u'no-repeat',
+                        u'background-position': u'-64px 0',
+                        u'width': u'64px',
+                        u'height': u'64px'})
+
+    def test_project_jobs(self):
+        self.create_image("sprites/icons/red.png", RED)
+        self.create_image("sprites/icons/blue.png", BLUE)
+        self.create_image("sprites/menu/green.png", GREEN, size=(128, 128))
+        self.create_image("sprites/menu/yellow.png", YELLOW)
+        self.create_image("sprites/tiny/pink.png", PINK, size=(8, 8))
+        code, output = self.call("glue sprites output --project --jobs=3", capture=True)
+        self.assertEqual(code, 0)
+
+        # The output of every sprite is grouped and in the usual order
+        self.assertTrue(output.index("Processing 'icons'") <
+                        output.index("Format 'css' for sprite 'icons'") <
+                        output.index("Processing 'menu'") <
+                        output.index("Format 'css' for sprite 'menu'") <
+                        output.index("Processing 'tiny'"))
+
+        self.assertColor("output/icons.png", RED, ((0, 0), (63, 63)))
+        self.assertColor("output/menu.png", GREEN, ((0, 0), (127, 127)))
+        self.assertColor("output/tiny.png", PINK, ((0, 0), (7, 7)))
+        self.assertExists("output/tiny.css")
+
+        code, output = self.call("glue sprites output --project --jobs=3", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'img'' for sprite 'menu' already exists" in output)
+
+        # Errors raised while building any sprite are propagated
+        with open("sprites/menu/broken.png", "w") as f:
+            f.write("broken")
+        code = self.call("glue sprites output --project --jobs=3")
+        self.assertEqual(code, 2)
+
     def test_algorithm_diagonal(self):
         self.create_image("simple/red.png", RED)
         self.create_image("simple/blue.png", BLUE)
@@ -522,6 +595,22 @@ class TestGlue(unittest.TestCase):
         assert red < blue
         assert blue < alpha_path
 
+    def test_image_release(self):
+        settings = {'crop': True, 'padding': '0', 'margin': '0', 'ratios': [1]}
+        path = self.create_image("simple/red.png", RED, (64, 64), margin=8)
+        red = Image(path, settings)
+
+        # The layout only needs the size of the image
+        self.assertEqual((red.width, red.height), (64, 64))
+        self.assertEqual((red.original_width, red.original_height), (72, 72))
+        self.assertFalse('image' in red.__dict__)
+        self.assertFalse(hasattr(red, '_image_data'))
+
+        self.assertEqual(red.image.getpixel((0, 0)), RED)
+        red.release()
+        self.assertFalse('image' in red.__dict__)
+        self.assertEqual(red.image.size, (64, 64))
+
     def test_css(self):
         self.create_image("simple/red.png", RED)
         self.create_image("simple/blue.png", BLUE)
@@ -953,6 +1042,25 @@ class TestGlue(unittest.TestCase):
             content = f.read()
             self.assertEqual(content, u"custom template for {0}".format(12345))
 
+    def test_css_template_hash_line(self):
+        self.create_image("simple/red.png", RED)
+        with open('template.jinja', 'w') as f:
+            f.write("/* glue: {{ version }} hash: {{ hash }} */\n"
+                    "{% for image in images %}.{{ image.label }}{}{% endfor %}")
+
+        code = self.call("glue simple output --css-template=template.jinja")
+        self.assertEqual(code, 0)
+        code, output = self.call("glue simple output --css-template=template.jinja", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'css'' for sprite 'simple' already exists" in output)
+        code = self.call("glue simple output --css-template=template.jinja --check")
+        self.assertEqual(code, 0)
+
+        # Images changing the hash of the sprite still rebuild it
+        self.create_image("simple/blue.png", BLUE)
+        code, output = self.call("glue simple output --css-template=template.jinja", capture=True)
+        self.assertTrue("Format 'css' for sprite 'simple' needs rebuild" in output)
+
     def test_html(self):
         self.create_image("simple/red.png", RED)
         self.create_image("simple/blue.png", BLUE)
@@ -975,6 +1083,10 @@ class TestGlue(unittest.TestCase):
             data = json.loads(f.read())
             assert isinstance(data['frames'], list)
 
+        code, output = self.call("glue simple output --json", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'json'' for sprite 'simple' already exists" in output)
+
     def test_json_ratios(self):
         self.create_image("simple/red.png", RED)
         self.create_image("simple/blue.png", BLUE)
@@ -1333,6 +1445,925 @@ class TestGlue(unittest.TestCase):
                         u'width': u'64px',
                         u'height': u'64px'})
 
+    def test_png_profile(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        for profile in ('fast', 'balanced', 'max'):
+            code, output = self.call("glue simple output -f --png-profile={0}".format(profile), capture=True)
+            self.assertEqual(code, 0)
+            self.assertTrue("simple.png encoded using '{0}' profile".format(profile) in output)
+
+            self.assertColor("output/simple.png", RED, ((0, 0), (63, 63)))
+            self.assertColor("output/simple.png", BLUE, ((64, 0), (127, 63)))
+
+    def test_png_profile_config_file(self):
+        self.create_image("simple/red.png", RED)
+        with open('simple/sprite.conf', 'w') as f:
+            f.write("[sprite]\npng_profile=fast\n")
+
+        code, output = self.call("glue simple output", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("simple.png encoded using 'fast' profile" in output)
+
+        with open('simple/sprite.conf', 'w') as f:
+            f.write("[sprite]\npng_profile=tiny\n")
+
+        code = self.call("glue simple output")
+        self.assertEqual(code, 3)
+
+    def test_png_optimize(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE, margin=8, margin_color=(0, 255, 0, 0))
+        code = self.call("glue simple output")
+        self.assertEqual(code, 0)
+        original_size = os.path.getsize("output/simple.png")
+
+        code, output = self.call("glue simple output --png-optimize", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("simple.png encoded using optimization pass" in output)
+        self.assertTrue(os.path.getsize("output/simple.png") <= original_size)
+
+        image = PILImage.open("output/simple.png").convert('RGBA')
+        image.save("output/rgba.png")
+        self.assertColor("output/rgba.png", BLUE, ((4, 4), (67, 67)))
+        self.assertColor("output/rgba.png", TRANSPARENT, ((0, 0), (71, 71)))
+        self.assertColor("output/rgba.png", RED, ((72, 0), (135, 63)))
+
+        code, output = self.call("glue simple output --png-optimize", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'img'' for sprite 'simple' already exists" in output)
+
+    def test_png_threads(self):
+        self.create_image("simple/red.png", RED, size=(64, 512))
+        self.create_image("simple/blue.png", BLUE, size=(64, 512), margin=8)
+        code, output = self.call("glue simple output --png-threads=4 --retina", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("simple@2x.png encoded using 'balanced' profile and 4 threads" in output)
+
+        self.assertColor("output/simple@2x.png", BLUE, ((4, 4), (67, 515)))
+        self.assertColor("output/simple@2x.png", TRANSPARENT, ((0, 0), (71, 519)))
+        self.assertColor("output/simple@2x.png", RED, ((72, 0), (135, 511)))
+        self.assertColor("output/simple.png", RED, ((37, 1), (66, 254)))
+
+        code, output = self.call("glue simple output --png-threads=4 --retina", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'img'' for sprite 'simple' already exists" in output)
+
+    def test_png_filters(self):
+        image = PILImage.new('RGBA', (17, 9), RED)
+        image.paste(BLUE, (3, 2, 9, 7))
+        image.paste((10, 20, 30, 40), (5, 0, 17, 3))
+        for mode in ('RGBA', 'RGB', 'LA', 'L'):
+            converted = image.convert(mode)
+            for method in ['adaptive'] + list(png.FILTERS):
+                data = png.encode(converted, [('Comment', 'hash')], method=method)
+                decoded = PILImage.open(StringIO(data))
+                self.assertEqual(decoded.mode, mode)
+                self.assertEqual(decoded.info['Comment'], 'hash')
+                self.assertEqual(decoded.tobytes(), converted.tobytes())
+
+    def test_png8_alpha(self):
+        self.create_image("simple/red.png", RED)
+        PILImage.new('RGBA', (64, 64), (0, 0, 255, 128)).save("simple/blue.png")
+        code = self.call("glue simple output --png8-alpha")
+        self.assertEqual(code, 0)
+
+        image = PILImage.open("output/simple.png")
+        self.assertEqual(image.mode, 'P')
+        self.assertTrue('transparency' in image.info)
+
+        image = image.convert('RGBA')
+        self.assertEqual(image.getpixel((0, 0)), RED)
+        self.assertEqual(image.getpixel((63, 63)), RED)
+        self.assertEqual(image.getpixel((64, 0)), (0, 0, 255, 128))
+        self.assertEqual(image.getpixel((127, 63)), (0, 0, 255, 128))
+
+    def test_webp(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        code = self.call("glue simple output --webp --retina")
+        self.assertEqual(code, 0)
+
+        self.assertExists("output/simple.png")
+        self.assertExists("output/simple.webp")
+        self.assertExists("output/simple@2x.webp")
+        self.assertExists("output/simple.css")
+        self.assertColor("output/simple@2x.webp", RED[:3], ((0, 0), (63, 63)))
+        self.assertColor("output/simple@2x.webp", BLUE[:3], ((64, 0), (127, 63)))
+
+        with codecs.open("output/simple.css", 'r', 'utf-8-sig') as f:
+            css = f.read()
+        self.assertTrue("background-image: image-set(url('simple.webp') type('image/webp'), "
+                        "url('simple.png') type('image/png'));" in css)
+        self.assertTrue("background-image: image-set(url('simple@2x.webp') type('image/webp'), "
+                        "url('simple@2x.png') type('image/png'));" in css)
+
+        self.assertCSS(u"output/simple.css", u'.sprite-simple-red',
+                       {u'background-image': u'image-set(url(simple.webp) type("image/webp"), url(simple.png) type("image/png"))',
+                        u'background-repeat': u'no-repeat',
+                        u'background-position': u'0 0',
+                        u'width': u'32px',
+                        u'height': u'32px'})
+
+        code, output = self.call("glue simple output --webp --retina", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'webp'' for sprite 'simple' already exists" in output)
+
+        code = self.call("glue simple output --webp --webp-quality=50 --url=http://static/")
+        self.assertEqual(code, 0)
+        with codecs.open("output/simple.css", 'r', 'utf-8-sig') as f:
+            self.assertTrue("url('http://static/simple.webp') type('image/webp')" in f.read())
+
+    def test_avif(self):
+        self.create_image("simple/red.png", RED)
+        if PILImage.init() or 'AVIF' not in PILImage.SAVE:
+            self.assertRaises(SystemExit, self.call, "glue simple output --avif")
+            return
+
+        code = self.call("glue simple output --avif")
+        self.assertEqual(code, 0)
+        self.assertExists("output/simple.avif")
+
+    def test_png_reduce(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE, margin=8)
+        code = self.call("glue simple output --png-reduce")
+        self.assertEqual(code, 0)
+
+        image = PILImage.open("output/simple.png")
+        self.assertEqual(image.mode, 'P')
+        image = image.convert('RGBA')
+        self.assertEqual(image.getpixel((4, 4)), BLUE)
+        self.assertEqual(image.getpixel((0, 0)), TRANSPARENT)
+        self.assertEqual(image.getpixel((72, 0)), RED)
+
+        shutil.rmtree("simple")
+        self.create_image("simple/black.png", (0, 0, 0, 255))
+        self.create_image("simple/gray.png", (128, 128, 128, 255))
+        code = self.call("glue simple output --png-reduce")
+        self.assertEqual(code, 0)
+        self.assertEqual(PILImage.open("output/simple.png").mode, 'L')
+
+    def test_streaming(self):
+        self.create_image("simple/red.png", RED, size=(64, 200))
+        self.create_image("simple/blue.png", BLUE, size=(64, 150), margin=8)
+        PILImage.new('RGBA', (30, 90), (10, 200, 30, 128)).save("simple/green.png")
+        code = self.call("glue simple output --ratios=2,1.5,1")
+        self.assertEqual(code, 0)
+        expected = dict((path, PILImage.open(path).convert('RGBA').tobytes())
+                        for path in glob.glob("output/*.png"))
+        shutil.rmtree("output")
+
+        code, output = self.call("glue simple output --ratios=2,1.5,1 --streaming --band-height=16", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("simple@2x.png encoded using 'balanced' profile streaming bands of 16 rows" in output)
+        self.assertEqual(sorted(expected), sorted(glob.glob("output/*.png")))
+        for path, data in expected.iteritems():
+            self.assertEqual(PILImage.open(path).convert('RGBA').tobytes(), data)
+
+        code, output = self.call("glue simple output --ratios=2,1.5,1 --streaming --band-height=16", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'img'' for sprite 'simple' already exists" in output)
+
+        code = self.call("glue simple output --streaming --png8")
+        self.assertEqual(code, 3)
+        with open("simple/sprite.conf", "w") as f:
+            f.write("[sprite]\nstreaming=true\npng8=true\n")
+        code = self.call("glue simple output")
+        self.assertEqual(code, 3)
+        os.remove("simple/sprite.conf")
+        self.assertRaises(SystemExit, self.call, "glue simple output --band-height=0")
+
+    def test_max_memory(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        code, output = self.call("glue simple output --max-memory=1G", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("simple.png encoded using 'balanced' profile:" in output)
+
+        code, output = self.call("glue simple output -f --max-memory=64K --band-height=16", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Using --streaming to build 'simple' within --max-memory" in output)
+        self.assertTrue("simple.png encoded using 'balanced' profile streaming bands of 16 rows" in output)
+        self.assertColor("output/simple.png", RED, ((0, 0), (63, 63)))
+        self.assertColor("output/simple.png", BLUE, ((64, 0), (127, 63)))
+
+        code = self.call("glue simple output -f --max-memory=40K --band-height=16")
+        self.assertEqual(code, 6)
+
+        code = self.call("glue simple output -f --max-memory=64K --band-height=16 --png8")
+        self.assertEqual(code, 6)
+
+        self.assertRaises(SystemExit, self.call, "glue simple output --max-memory=lots")
+
+    def test_build_threads(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        code, output = self.call("glue simple output --build-threads=4 --ratios=2,1.5,1 --css --json --webp", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("simple@1.5x.png encoded using" in output)
+        self.assertTrue("simple@2x.webp encoded using" in output)
+
+        self.assertColor("output/simple@2x.png", RED, ((0, 0), (63, 63)))
+        self.assertColor("output/simple@2x.png", BLUE, ((64, 0), (127, 63)))
+        self.assertColor("output/simple.png", RED, ((0, 0), (30, 31)))
+        self.assertColor("output/simple@2x.webp", RED[:3], ((0, 0), (63, 63)))
+        self.assertCSS(u"output/simple.css", u'.sprite-simple-blue',
+                       {u'background-image': (u'image-set(url(simple.webp) type("image/webp"), '
+                                              u'url(simple.png) type("image/png"))'),
+                        u'background-repeat': u'no-repeat',
+                        u'background-position': u'-32px 0',
+                        u'width': u'32px',
+                        u'height': u'32px'})
+        self.assertExists("output/simple@1.5x.json")
+
+        code, output = self.call("glue simple output --build-threads=4 --ratios=2,1.5,1 --css --json --webp", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'img'' for sprite 'simple' already exists" in output)
+        self.assertTrue("Format 'css'' for sprite 'simple' already exists" in output)
+
+        # sprite.conf can set it for every sprite
+        with open("simple/sprite.conf", "w") as f:
+            f.write("[sprite]\nbuild_threads=2\n")
+        with patch('glue.managers.base.BaseManager.build_formats') as build_formats:
+            code = self.call("glue simple output --force")
+        self.assertEqual(code, 0)
+        self.assertEqual(build_formats.call_args[0][2], 2)
+
+    def test_plan(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        code, output = self.call("glue simple output --plan", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Sprite 'simple' needs rebuild:" in output)
+        self.assertTrue("* no previous build manifest" in output)
+        self.assertTrue("img: output/simple.png missing" in output)
+        self.assertDoesNotExists("output/simple.png")
+
+        code = self.call("glue simple output --retina")
+        self.assertEqual(code, 0)
+        self.assertExists("output/.simple.glue-manifest")
+        self.assertEqual(sorted(PILImage.open("output/simple@2x.png").info), ['Comment', 'Software'])
+
+        # Unchanged images are neither read nor decoded
+        with patch('glue.core.Image._decode', side_effect=AssertionError):
+            with patch('glue.core.Image.digest', None):
+                code, output = self.call("glue simple output --retina --plan", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Sprite 'simple' is up to date:" in output)
+        self.assertTrue("img: output/simple@2x.png up to date" in output)
+        self.assertTrue("css: output/simple.css up to date" in output)
+
+        self.create_image("simple/yellow.png", YELLOW)
+        os.remove("simple/red.png")
+        self.create_image("simple/blue.png", GREEN)
+        code, output = self.call("glue simple output --retina --padding=2 --plan", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Sprite 'simple' needs rebuild:" in output)
+        self.assertTrue("* new files: yellow.png" in output)
+        self.assertTrue("* removed files: red.png" in output)
+        self.assertTrue("* changed files: blue.png" in output)
+        self.assertTrue("* config changed: padding" in output)
+        self.assertTrue("img: output/simple.png stale" in output)
+        self.assertTrue("css: output/simple.css stale" in output)
+
+    def test_format_hashes(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        code = self.call("glue simple output --css --json")
+        self.assertEqual(code, 0)
+
+        # Options of a text format only rebuild that format
+        code, output = self.call("glue simple output --css --json --namespace=icon", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'img'' for sprite 'simple' already exists" in output)
+        self.assertTrue("Format 'json'' for sprite 'simple' already exists" in output)
+        self.assertTrue("Format 'css' for sprite 'simple' needs rebuild" in output)
+
+        # Encoder options only rebuild the image
+        code, output = self.call("glue simple output --css --json --namespace=icon --png-profile=fast", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'img' for sprite 'simple' needs rebuild" in output)
+        self.assertTrue("Format 'css'' for sprite 'simple' already exists" in output)
+        self.assertTrue("Format 'json'' for sprite 'simple' already exists" in output)
+
+        # Hashes don't depend on the current directory or runtime options
+        source, output_dir = os.path.abspath("simple"), os.path.abspath("output")
+        os.mkdir("other")
+        os.chdir("other")
+        try:
+            code, output = self.call("glue {0} {1} --css --json --namespace=icon --png-profile=fast "
+                                     "--build-threads=2 --io-threads=2".format(source, output_dir), capture=True)
+        finally:
+            os.chdir("..")
+        self.assertEqual(code, 0)
+        self.assertEqual(output.count("already exists"), 3)
+
+    def test_check(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        code, output = self.call("glue simple output --check --json", capture=True)
+        self.assertEqual(code, 7)
+        self.assertTrue("output/simple.png is missing" in output)
+        self.assertDoesNotExists("output/simple.png")
+
+        code = self.call("glue simple output --css --json --html")
+        self.assertEqual(code, 0)
+        code, output = self.call("glue simple output --check --css --json --html", capture=True)
+        self.assertEqual(code, 0)
+        self.assertEqual(output, "")
+
+        self.create_image("simple/blue.png", GREEN)
+        code, output = self.call("glue simple output --check --css --json --html", capture=True)
+        self.assertEqual(code, 7)
+        self.assertTrue("output/simple.png is stale" in output)
+        self.assertTrue("output/simple.json is stale" in output)
+        self.assertTrue("output/simple.css is stale" in output)
+
+    def test_watchers(self):
+        self.create_image("sprites/icons/red.png", RED)
+        watchers = [watchers_module.PollingWatcher(os.path.abspath("sprites"), debounce=0.3)]
+        if watchers_module.InotifyWatcher.available():
+            watchers.append(watchers_module.InotifyWatcher(os.path.abspath("sprites"), debounce=0.3))
+
+        self.create_image("sprites/icons/blue.png", BLUE)
+        self.create_image("sprites/menu/green.png", GREEN)
+        self.create_image("sprites/menu/.hidden.png", GREEN)
+        with open("sprites/.glueignore", "w") as f:
+            f.write("*.gif\n")
+        for watcher in watchers:
+            changes = watcher.wait()
+            watcher.close()
+            self.assertEqual(set(os.path.relpath(c) for c in changes) - set(["sprites/menu"]),
+                             set(["sprites/icons/blue.png", "sprites/menu/green.png",
+                                  "sprites/.glueignore"]))
+
+    def test_inotify_watch_failures(self):
+        if not watchers_module.InotifyWatcher.available():
+            return
+        self.create_image("sprites/icons/red.png", RED)
+        path = os.path.abspath("sprites")
+
+        class FullLibc(object):
+            """libc whose inotify_add_watch fails like if
+            fs.inotify.max_user_watches was reached."""
+            def __init__(self, libc):
+                self.libc = libc
+
+            def __getattr__(self, name):
+                return getattr(self.libc, name)
+
+            def inotify_add_watch(self, fd, path, mask):
+                return -1
+
+        # Fall back to polling if the initial folders can't be watched
+        real_cdll = watchers_module.ctypes.CDLL
+        with patch('glue.watchers.ctypes.CDLL', side_effect=lambda *a, **kw: FullLibc(real_cdll(*a, **kw))):
+            with patch('glue.watchers.ctypes.get_errno', return_value=errno.ENOSPC):
+                watcher = watchers_module.get_watcher(path)
+        self.assertTrue(isinstance(watcher, watchers_module.PollingWatcher))
+
+        # Rebuild everything if a new folder can't be watched
+        watcher = watchers_module.InotifyWatcher(path, debounce=0.3)
+        watcher.libc = FullLibc(watcher.libc)
+        self.create_image("sprites/menu/green.png", GREEN)
+        stderr = StringIO()
+        with patch('glue.watchers.ctypes.get_errno', return_value=errno.ENOSPC):
+            with patch('sys.stderr', stderr):
+                changes = watcher.wait()
+        watcher.close()
+        self.assertTrue(changes is watcher.EVERYTHING)
+        self.assertTrue("Unable to watch" in stderr.getvalue())
+
+    def test_watch_rebuild(self):
+        self.create_image("sprites/icons/red.png", RED)
+        self.create_image("sprites/menu/green.png", GREEN)
+        code = self.call("glue sprites output --project")
+        self.assertEqual(code, 0)
+
+        watchers = []
+        with patch('glue.managers.WatchManager.process', autospec=True, side_effect=watchers.append):
+            self.call("glue sprites output --project --watch")
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        watch = watchers[0]
+
+        # Only the sprites affected by the changes are rebuilt
+        self.create_image("sprites/icons/red.png", YELLOW)
+        out = StringIO()
+        with redirect_stdout(out):
+            watch.rebuild(set([os.path.abspath("sprites/icons/red.png")]))
+        self.assertTrue("Processing 'icons'" in out.getvalue())
+        self.assertFalse("Processing 'menu'" in out.getvalue())
+        self.assertColor("output/icons.png", YELLOW, ((0, 0), (63, 63)))
+
+        with patch('glue.managers.ProjectManager.process') as process:
+            watch.rebuild(set([os.path.abspath("sprites/sprite.conf")]))
+            self.assertTrue(process.called)
+        manager = watch.create_manager()
+        self.assertEqual(manager.sprite_path_for(os.path.abspath("sprites/.glueignore")), None)
+        self.assertEqual(manager.sprite_path_for(os.path.abspath("sprites/icons/.glueignore")),
+                         os.path.abspath("sprites/icons"))
+
+        # Changes inside excluded folders are ignored
+        self.create_image("sprites/legacy/blue.png", BLUE)
+        watch.options['exclude'] = 'legacy'
+        out = StringIO()
+        with redirect_stdout(out):
+            watch.rebuild(set([os.path.abspath("sprites/legacy/blue.png")]))
+        self.assertFalse("Processing" in out.getvalue())
+        self.assertDoesNotExists("output/legacy.png")
+
+        # Sprites of other shards too
+        watch.options['exclude'] = None
+        watch.options['shard'] = '2/2'
+        manager = watch.create_manager()
+        paths = list(manager.find_sprite_paths())
+        results = []
+        for folder in ("icons", "menu", "legacy"):
+            path = os.path.join(manager.config['source'], folder)
+            results.append(manager.sprite_path_for(os.path.join(path, "a.png")))
+            self.assertEqual(results[-1], path if path in paths else False)
+        self.assertTrue(False in results)
+
+        # Folders are only searched once for every burst of changes
+        watch.options['shard'] = None
+        changes = set(os.path.abspath("sprites/icons/{0}.png".format(i)) for i in range(20))
+        with patch('glue.managers.ProjectManager.find_sprite_paths', autospec=True,
+                   side_effect=ProjectManager.find_sprite_paths) as find_sprite_paths:
+            with redirect_stdout(StringIO()):
+                watch.rebuild(changes)
+        self.assertEqual(find_sprite_paths.call_count, 1)
+
+    def test_watch_cache(self):
+        self.create_image("sprites/icons/red.png", RED)
+        self.create_image("sprites/icons/blue.png", BLUE)
+        watchers = []
+        with patch('glue.managers.WatchManager.process', autospec=True, side_effect=watchers.append):
+            self.call("glue sprites output --project --watch")
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        watch = watchers[0]
+        watch.rebuild(None)
+
+        def touch(path, color, size=(64, 64)):
+            self.create_image(path, color, size)
+            mtime = os.path.getmtime(path) + 10
+            os.utime(path, (mtime, mtime))
+
+        # Only the changed image is decoded and repainted
+        touch("sprites/icons/red.png", YELLOW)
+        with patch.object(Image, '_decode', autospec=True, side_effect=Image._decode) as decode:
+            watch.rebuild(set([os.path.abspath("sprites/icons/red.png")]))
+        self.assertEqual([os.path.basename(c[0][0].path) for c in decode.call_args_list], ["red.png"])
+        self.assertColor("output/icons.png", YELLOW, ((0, 0), (63, 63)))
+        self.assertColor("output/icons.png", BLUE, ((64, 0), (127, 63)))
+
+        # If the canvas size changes everything is pasted again
+        touch("sprites/icons/blue.png", GREEN, (32, 32))
+        with patch.object(Image, '_decode', autospec=True, side_effect=Image._decode) as decode:
+            watch.rebuild(set([os.path.abspath("sprites/icons/blue.png")]))
+        self.assertEqual([os.path.basename(c[0][0].path) for c in decode.call_args_list], ["blue.png"])
+        self.assertColor("output/icons.png", YELLOW, ((0, 0), (63, 63)))
+        self.assertColor("output/icons.png", GREEN, ((64, 0), (95, 31)))
+        self.assertColor("output/icons.png", TRANSPARENT, ((64, 32), (95, 63)))
+
+    def test_image_cache(self):
+        cache = ImageCache(64 * 64 * 4 * 2)
+        for name in ('a', 'b', 'c'):
+            cache.put(name, name, PILImage.new('RGBA', (64, 64)))
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 'b')
+        cache.put('d', 'd', PILImage.new('RGBA', (64, 64)))
+        self.assertEqual(cache.get('c'), None)
+        self.assertEqual(cache.get('b'), 'b')
+        self.assertEqual(cache.size, 64 * 64 * 4 * 2)
+
+        # Values bigger than the cache itself are not stored
+        cache.put('e', 'e', PILImage.new('RGBA', (128, 128)))
+        self.assertEqual(cache.get('e'), None)
+
+    def test_repaint_previous_canvas(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        code = self.call("glue simple output --retina")
+        self.assertEqual(code, 0)
+
+        # Only the changed image is decoded and pasted over the previous canvas
+        self.create_image("simple/red.png", YELLOW)
+        with patch.object(Image, '_decode', autospec=True, side_effect=Image._decode) as decode:
+            code, output = self.call("glue simple output --retina", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Repainting 1 of 2 images over the previous canvas" in output)
+        self.assertEqual([os.path.basename(c[0][0].path) for c in decode.call_args_list], ["red.png"])
+        self.assertColor("output/simple@2x.png", YELLOW, ((0, 0), (63, 63)))
+        self.assertColor("output/simple@2x.png", BLUE, ((64, 0), (127, 63)))
+        self.assertColor("output/simple.png", YELLOW, ((0, 0), (31, 31)), .1)
+        self.assertColor("output/simple.png", BLUE, ((32, 0), (63, 31)), .1)
+
+        # If the layout changes the whole canvas is composed again
+        self.create_image("simple/red.png", RED, (32, 32))
+        code, output = self.call("glue simple output --retina", capture=True)
+        self.assertEqual(code, 0)
+        self.assertFalse("Repainting" in output)
+        self.assertColor("output/simple@2x.png", BLUE, ((0, 0), (63, 63)))
+        self.assertColor("output/simple@2x.png", RED, ((64, 0), (95, 31)))
+
+        # Quantized images are never reused
+        for option in ("--png8", "--png8-alpha"):
+            code = self.call("glue simple output {0}".format(option))
+            self.assertEqual(code, 0)
+            self.create_image("simple/blue.png", GREEN)
+            code, output = self.call("glue simple output {0}".format(option), capture=True)
+            self.assertEqual(code, 0)
+            self.assertFalse("Repainting" in output)
+            self.create_image("simple/blue.png", BLUE)
+
+    def test_artifact_cache(self):
+        self.create_image("project/simple/red.png", RED)
+        self.create_image("project/simple/blue.png", BLUE)
+        code, output = self.call("glue project/simple project/output --artifact-cache=cache", capture=True)
+        self.assertEqual(code, 0)
+        self.assertFalse("artifact cache" in output)
+        with open("project/output/simple.png", "rb") as f:
+            built = f.read()
+
+        # The same sprite in other folder is restored from the cache
+        shutil.copytree("project/simple", "other/simple")
+        os.utime("other/simple/red.png", (0, 0))
+        code, output = self.call("glue other/simple other/output --artifact-cache=cache", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Sprite 'simple' restored from the artifact cache" in output)
+        self.assertFalse("Processing" in output.split("restored")[1])
+        with open("other/output/simple.png", "rb") as f:
+            self.assertEqual(f.read(), built)
+        self.assertExists("other/output/simple.css")
+
+        # Changed sprites are built and stored again
+        self.create_image("other/simple/red.png", YELLOW)
+        code, output = self.call("glue other/simple other/output --artifact-cache=cache", capture=True)
+        self.assertFalse("artifact cache" in output)
+        self.assertColor("other/output/simple.png", YELLOW, ((0, 0), (63, 63)))
+        self.assertEqual(len(os.listdir("cache")), 2)
+
+    def test_artifact_cache_eviction(self):
+        self.create_image("simple/red.png", RED)
+        cache = ArtifactCache("cache", os.path.getsize("simple/red.png") * 2)
+        for key in ("a", "b"):
+            cache.store(key, [("img", "simple/red.png")])
+            os.utime(os.path.join("cache", key), (ord(key), ord(key)))
+
+        # The least recently used entry is evicted
+        self.assertTrue(cache.restore("a", [("img", "restored/red.png")]))
+        cache.store("c", [("img", "simple/red.png")])
+        self.assertEqual(sorted(os.listdir("cache")), ["a", "c"])
+        self.assertFalse(cache.restore("b", [("img", "restored/blue.png")]))
+        with open("simple/red.png", "rb") as source, open("restored/red.png", "rb") as restored:
+            self.assertEqual(source.read(), restored.read())
+
+        # Entries other processes remove meanwhile don't break the build
+        walk, rmtree = os.walk, shutil.rmtree
+        def removed_walk(path, *args, **kwargs):
+            if path.endswith("a"):
+                rmtree(path)
+            return walk(path, *args, **kwargs)
+        with patch('os.walk', side_effect=removed_walk):
+            cache.store("d", [("img", "simple/red.png")])
+        self.assertEqual(sorted(os.listdir("cache")), ["c", "d"])
+
+        def busy_rmtree(path, *args):
+            if args:
+                return rmtree(path, *args)
+            raise OSError(errno.EBUSY, "Device or resource busy")
+        with patch('shutil.rmtree', side_effect=busy_rmtree):
+            cache.store("e", [("img", "simple/red.png")])
+        self.assertEqual(sorted(os.listdir("cache")), ["c", "d", "e"])
+
+    def test_shard(self):
+        self.create_image("sprites/big/red.png", RED, (128, 128))
+        self.create_image("sprites/big/blue.png", BLUE, (128, 128))
+        self.create_image("sprites/medium/red.png", RED, (96, 96))
+        self.create_image("sprites/small/red.png", RED, (32, 32))
+        self.create_image("sprites/tiny/red.png", RED, (8, 8))
+
+        code = self.call("glue sprites output --project --shard=1/2")
+        self.assertEqual(code, 0)
+        self.assertEqual(sorted(glob.glob("output/*.png")), ["output/big.png"])
+
+        # Every shard reports the missing outputs of the others
+        code, output = self.call("glue sprites output --project --shard-merge=2", capture=True)
+        self.assertEqual(code, 7)
+        self.assertTrue("Shard 1/2: 1 sprites up to date" in output)
+        self.assertTrue("Shard 2/2: 6 output files are not up to date" in output)
+
+        code = self.call("glue sprites output --project --shard=2/2")
+        self.assertEqual(code, 0)
+        self.assertEqual(sorted(glob.glob("output/*.png")),
+                         ["output/big.png", "output/medium.png", "output/small.png", "output/tiny.png"])
+
+        code, output = self.call("glue sprites output --project --shard-merge=2", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Shard 2/2: 3 sprites up to date" in output)
+
+        # Shards without sprites don't fail
+        code = self.call("glue sprites output --project --shard=6/6")
+        self.assertEqual(code, 0)
+
+        self.assertRaises(SystemExit, self.call, "glue sprites output --project --shard=3/2")
+        self.assertRaises(SystemExit, self.call, "glue sprites output --shard=1/2")
+
+    def test_include_exclude(self):
+        self.create_image("sprites/icons/red.png", RED)
+        self.create_image("sprites/icons/blue.png", BLUE)
+        self.create_image("sprites/icons/sub/green.png", GREEN)
+        self.create_image("sprites/icons/sub/red_old.png", RED)
+        self.create_image("sprites/icons/old/yellow.png", YELLOW)
+        self.create_image("sprites/drafts/pink.png", PINK)
+        with open("sprites/icons/sub/.glueignore", "w") as f:
+            f.write("# Old images\n*_old.png\n")
+
+        def images(sprite):
+            with open("output/{0}.css".format(sprite)) as f:
+                return sorted(set(re.findall(r'\.sprite-{0}-(\w+)'.format(sprite), f.read())))
+
+        code = self.call("glue sprites output --project --recursive --exclude=drafts,old")
+        self.assertEqual(code, 0)
+        self.assertEqual(images("icons"), ["blue", "green", "red"])
+        self.assertDoesNotExists("output/drafts.png")
+
+        code = self.call("glue sprites output --project --recursive --include=sub/*,red.png --exclude=drafts")
+        self.assertEqual(code, 0)
+        self.assertEqual(images("icons"), ["green", "red"])
+        self.assertEqual(self.call("glue sprites/drafts output --include=red.png"), 4)
+
+    def test_io_threads(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        self.create_image("simple/green.png", GREEN)
+        self.create_image("simple/yellow.png", YELLOW)
+
+        threads = []
+        read = Image.read.im_func
+
+        def record(image):
+            threads.append(threading.current_thread().name)
+            return read(image)
+
+        # Every file is read only once, in the background
+        with patch.object(Image, 'read', autospec=True, side_effect=record):
+            code = self.call("glue simple output --io-threads=4 --crop")
+        self.assertEqual(code, 0)
+        self.assertEqual(len(threads), 4)
+        self.assertFalse(threading.current_thread().name in threads)
+
+        code = self.call("glue simple serial --crop")
+        self.assertEqual(code, 0)
+        self.assertEqual(PILImage.open("output/simple.png").tobytes(),
+                         PILImage.open("serial/simple.png").tobytes())
+
+    def test_image_data_not_kept(self):
+        self.create_image("simple/red.png", RED)
+        with open("simple/red.png", "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+
+        reads = []
+        read = Image.read.im_func
+
+        def record(image):
+            reads.append(image.path)
+            return read(image)
+
+        # Without --io-threads files are read when needed and never kept
+        with redirect_stdout(StringIO()):
+            image = Image(os.path.abspath("simple/red.png"), {'crop': True})
+        with patch.object(Image, 'read', autospec=True, side_effect=record):
+            image.bbox
+            self.assertEqual(image.digest, digest)
+            image.image
+        self.assertEqual(len(reads), 2)
+        self.assertFalse('data' in image.__dict__)
+
+    def test_atomic_write(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        code = self.call("glue simple output")
+        self.assertEqual(code, 0)
+        os.utime("output/simple.css", (0, 0))
+        os.utime("output/simple.png", (0, 0))
+        inode = os.stat("output/simple.css").st_ino
+
+        # Identical files are not written again
+        code, output = self.call("glue simple output --force", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("(unchanged)" in output)
+        self.assertEqual(os.path.getmtime("output/simple.css"), 0)
+        self.assertEqual(os.path.getmtime("output/simple.png"), 0)
+
+        # Changed files are replaced by a new one
+        self.create_image("simple/red.png", YELLOW)
+        code, output = self.call("glue simple output", capture=True)
+        self.assertFalse("(unchanged)" in output)
+        self.assertNotEqual(os.stat("output/simple.css").st_ino, inode)
+        self.assertNotEqual(os.path.getmtime("output/simple.png"), 0)
+        self.assertEqual(sorted(os.listdir("output")), [".simple.glue-manifest", "simple.css", "simple.png"])
+
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat("output/simple.css").st_mode & 0o777, 0o666 & ~umask)
+
+    def test_file_lock(self):
+        events = []
+
+        def worker(name):
+            with file_lock("output.png"):
+                events.append(name)
+                time.sleep(0.1)
+                events.append(name)
+
+        with file_lock("output.png"):
+            self.assertExists(".output.png.lock")
+            threads = [threading.Thread(target=worker, args=(n,)) for n in "ab"]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.1)
+            self.assertEqual(events, [])
+        for thread in threads:
+            thread.join()
+
+        # Only one thread held the lock at the same time
+        self.assertEqual(events[0], events[1])
+        self.assertEqual(events[2], events[3])
+        self.assertDoesNotExists(".output.png.lock")
+
+    def test_concurrent_builds(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        env = dict(os.environ, PYTHONPATH=self.base_path)
+        command = [sys.executable, "-c", "import sys; from glue.bin import main; sys.exit(main())",
+                   "simple", "output"]
+        processes = [subprocess.Popen(command, env=env, stdout=subprocess.PIPE) for _ in range(4)]
+        outputs = [p.communicate()[0] for p in processes]
+        self.assertEqual([p.returncode for p in processes], [0] * 4)
+
+        # Only one of them built the sprite, the others found it up to date
+        self.assertEqual(sum(o.count("Format 'img' for sprite 'simple' needs rebuild") for o in outputs), 1)
+        self.assertColor("output/simple.png", RED, ((0, 0), (63, 63)))
+        self.assertEqual(sorted(os.listdir("output")), [".simple.glue-manifest", "simple.css", "simple.png"])
+
+    def test_serve(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+
+        server = create_server(port=0, memory=True, quiet=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://{0}/'.format(server.address)
+
+            def build(args, headers={'Content-Type': 'application/json'}):
+                request = urllib2.Request(url + 'build', json.dumps({'args': args}), headers)
+                try:
+                    response = urllib2.urlopen(request)
+                except urllib2.HTTPError, e:
+                    response = e
+                return response.code, json.loads(response.read())
+
+            code, result = build(["simple", "output"])
+            self.assertEqual(code, 200)
+            self.assertEqual(result['status'], 'ok')
+            self.assertEqual(sorted(result['outputs']), ["output/simple.css", "output/simple.png"])
+            self.assertTrue("Processing 'simple'" in result['output'])
+            self.assertColor("output/simple.png", RED, ((0, 0), (63, 63)))
+
+            # Files are served from memory
+            os.remove("output/simple.png")
+            response = urllib2.urlopen(url + 'output/simple.png')
+            self.assertEqual(response.headers['Content-Type'], 'image/png')
+            self.assertEqual(PILImage.open(StringIO(response.read())).getpixel((0, 0)), RED)
+
+            code, result = build(["missing", "output"])
+            self.assertEqual(code, 422)
+            self.assertEqual(result['code'], 2)
+            self.assertTrue("Directory not found" in result['errors'])
+
+            status = json.loads(urllib2.urlopen(url + 'status').read())
+            self.assertEqual(status['builds'], 2)
+            self.assertTrue(status['cache_size'] > 0)
+
+            # Requests web pages could send are rejected
+            self.assertEqual(build(["simple", "output"], {'Content-Type': 'text/plain'})[0], 415)
+            self.assertEqual(build(["simple", "output"], {'Content-Type': 'application/json',
+                                                          'Origin': 'http://example.com'})[0], 403)
+            self.assertEqual(build(["simple", "output"], {'Content-Type': 'application/json',
+                                                          'Host': 'example.com:8123'})[0], 403)
+            code, result = build(["simple", "output"], {'Content-Type': 'application/json',
+                                                        'Origin': 'http://{0}'.format(server.address)})
+            self.assertEqual(code, 200)
+            self.assertEqual(json.loads(urllib2.urlopen(url + 'status').read())['builds'], 3)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_batch(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        self.create_image("other/red.png", RED)
+
+        with open("jobs.json", "w") as f:
+            json.dump([["simple", "output"],
+                       {"name": "retina", "args": ["simple", "retina", "--retina"]},
+                       ["missing", "output"],
+                       ["other", "output", "--img=other-img"]], f)
+
+        for jobs in ("1", "2"):
+            shutil.rmtree("output", True)
+            shutil.rmtree("retina", True)
+            shutil.rmtree("other-img", True)
+            output = StringIO()
+            with redirect_stdout(output):
+                code = main(["glue", "batch", "jobs.json", "--jobs", jobs, "-q",
+                             "--report", "report.json"])
+            self.assertEqual(code, 2)
+            self.assertTrue("Job 2/4 'retina': ok (code 0)" in output.getvalue())
+            self.assertTrue("Job 3/4 'missing output': error (code 2)" in output.getvalue())
+            self.assertTrue("4 jobs finished, 1 failed" in output.getvalue())
+
+            self.assertColor("output/simple.png", RED, ((0, 0), (63, 63)))
+            self.assertColor("retina/simple@2x.png", RED, ((0, 0), (63, 63)))
+            self.assertColor("other-img/other.png", RED, ((0, 0), (63, 63)))
+
+            with open("report.json") as f:
+                report = json.load(f)
+            self.assertEqual([r['code'] for r in report], [0, 0, 2, 0])
+            self.assertEqual(report[1]['name'], 'retina')
+            self.assertTrue("Directory not found" in report[2]['errors'])
+
+        # Source folders named like a subcommand are still built
+        self.create_image("batch/red.png", RED)
+        code = self.call("glue batch output")
+        self.assertEqual(code, 0)
+        self.assertColor("output/batch.png", RED, ((0, 0), (63, 63)))
+
+    def test_serve_unix_socket(self):
+        self.create_image("simple/red.png", RED)
+
+        server = create_server(unix_socket='glue.sock', quiet=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            body = json.dumps({'args': ["simple", "output"]})
+            client = socket.socket(socket.AF_UNIX)
+            client.connect('glue.sock')
+            client.sendall("POST /build HTTP/1.0\r\nContent-Type: application/json\r\n"
+                           "Content-Length: {0}\r\n\r\n{1}".format(len(body), body))
+            response = client.makefile().read()
+            client.close()
+            self.assertTrue(response.startswith("HTTP/1.0 200"))
+            self.assertEqual(json.loads(response.split("\r\n\r\n", 1)[1])['status'], 'ok')
+            self.assertExists("output/simple.png")
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertDoesNotExists('glue.sock')
+
+    def test_jpg(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        code = self.call("glue simple output --jpg --jpg-quality=95")
+        self.assertEqual(code, 0)
+
+        self.assertExists("output/simple.png")
+        self.assertExists("output/simple.jpg")
+        self.assertColor("output/simple.jpg", RED[:3], ((2, 2), (61, 61)), tolerance=10)
+        self.assertColor("output/simple.jpg", BLUE[:3], ((66, 2), (125, 61)), tolerance=10)
+
+        code, output = self.call("glue simple output --jpg --jpg-quality=95", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'jpg'' for sprite 'simple' already exists" in output)
+
+    def test_jpg_css(self):
+        # The transparent margin is flattened onto white in the jpg sprite,
+        # so it must not be offered instead of the png one.
+        self.create_image("simple/red.png", RED, margin=4)
+        code = self.call("glue simple output --jpg --webp")
+        self.assertEqual(code, 0)
+        self.assertExists("output/simple.jpg")
+
+        with codecs.open("output/simple.css", 'r', 'utf-8-sig') as f:
+            css = f.read()
+        self.assertFalse("simple.jpg" in css)
+        self.assertTrue("image-set(url('simple.webp') type('image/webp'), "
+                        "url('simple.png') type('image/png'))" in css)
+
+        code = self.call("glue simple output --jpg")
+        self.assertEqual(code, 0)
+        self.assertCSS("output/simple.css", ".sprite-simple-red",
+                       {u'background-image': u'url(simple.png)',
+                        u'background-repeat': u'no-repeat',
+                        u'background-position': u'0 0',
+                        u'width': u'68px',
+                        u'height': u'68px'})
+
     def test_retina(self):
 
         self.create_image("simple/red.png", RED)